@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control for ageobot.
+
+Each request gets a rough cost before we decode anything, from the image
+header and the parameters. Cheap and expensive requests are admitted
+through separate limits, so one huge image can't hold up the small ones,
+and each class has a short wait queue. When the queue is full, or a
+request waits too long, it gets a fast 429 (expensive requests) or 503
+(cheap ones) with a Retry-After header, instead of timing out.
+
+The limits are shared by all the workers in a container: each running
+request holds a lock on one of a fixed number of slot files in the cache
+directory, so the OS does the counting and a crashed worker's slots are
+freed with it. The wait queues are per worker. Environment:
+
+    FREQBOT_LARGE_COST     Cost above which a request is 'large', default 50.
+    FREQBOT_SMALL_LIMIT    Small requests running at once, default one per
+                           CPU.
+    FREQBOT_LARGE_LIMIT    Large requests running at once, default 1.
+    FREQBOT_QUEUE          Requests waiting per class, default 8.
+    FREQBOT_QUEUE_TIMEOUT  Seconds a request may wait, default 10.
+"""
+import asyncio
+import contextlib
+import fcntl
+import math
+import os
+import threading
+import time
+
+import cache
+from errors import Overloaded
+
+
+LARGE_COST = float(os.environ.get('FREQBOT_LARGE_COST', '50'))
+SMALL_LIMIT = int(os.environ.get('FREQBOT_SMALL_LIMIT',
+                                 os.cpu_count() or 4))
+LARGE_LIMIT = int(os.environ.get('FREQBOT_LARGE_LIMIT', '1'))
+QUEUE = int(os.environ.get('FREQBOT_QUEUE', '8'))
+QUEUE_TIMEOUT = float(os.environ.get('FREQBOT_QUEUE_TIMEOUT', '10'))
+
+# How often a waiting request looks for a free slot, in seconds.
+POLL = 0.05
+
+
+def estimate_cost(width, height, target, ntraces, method, segy):
+    """
+    Rough cost of a request, in millions of sample operations.
+
+    Decoding touches every pixel and resampling every output sample. The
+    crossing and FFT methods are about n log n per trace, but the
+    autocorrelation is a direct convolution, so n squared. Writing SEG-Y
+    touches every sample of every column.
+    """
+    cost = width * height
+    if target != height:
+        cost += width * target
+
+    n = max(target, 2)
+    if method == 'auto':
+        per_trace = n * n
+    else:
+        per_trace = 10 * n * math.log2(n)
+    cost += min(ntraces, width) * per_trace
+
+    if segy:
+        cost += 4 * width * target
+
+    return cost / 1e6
+
+
+class AdmissionController(object):
+    """
+    Per-class concurrency limits, across processes, with a bounded wait
+    queue in each.
+
+    Safe to use from threads, with admit(), and from an event loop, with
+    admit_async(); both share the same slots.
+    """
+    def __init__(self, directory=None, large_cost=LARGE_COST,
+                 limits=None, queue=QUEUE, timeout=QUEUE_TIMEOUT):
+        self.directory = directory or os.path.join(cache.CACHE_DIR,
+                                                   'admission')
+        self.large_cost = large_cost
+        self.limits = limits or {'small': SMALL_LIMIT, 'large': LARGE_LIMIT}
+        self.queue = queue
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._holders = {}
+        self._waiting = {c: 0 for c in self.limits}
+        self._seconds = {c: 1.0 for c in self.limits}
+        os.makedirs(self.directory, exist_ok=True)
+
+    def classify(self, cost):
+        if cost is None or cost <= self.large_cost:
+            return 'small'
+        return 'large'
+
+    def _slots(self, cls):
+        return [os.path.join(self.directory, '{}.{}.lock'.format(cls, k))
+                for k in range(self.limits[cls])]
+
+    def _take(self, cls):
+        """
+        Lock a free slot and return its file, or None if they're all
+        taken, by any worker.
+        """
+        for path in self._slots(cls):
+            f = open(path, 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f
+            except OSError:
+                f.close()
+        return None
+
+    def _running(self, cls):
+        """
+        How many slots are taken, found by trying them.
+        """
+        n = 0
+        for path in self._slots(cls):
+            with open(path, 'a') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    n += 1
+        return n
+
+    def stats(self):
+        """
+        Requests running in all workers and waiting in this one, by class.
+        """
+        with self._lock:
+            waiting = dict(self._waiting)
+        return {'running': {c: self._running(c) for c in self.limits},
+                'waiting': waiting}
+
+    def retry_after(self, cls):
+        """
+        Seconds until the work ahead of a new request has likely drained.
+        """
+        ahead = self._running(cls) + self._waiting[cls]
+        return max(1, int(math.ceil(self._seconds[cls] * ahead /
+                                    max(self.limits[cls], 1))))
+
+    def _reject(self, cls):
+        mess = 'Server busy, try again later.'
+        status_code = 429 if cls == 'large' else 503
+        raise Overloaded(mess, self.retry_after(cls), status_code=status_code)
+
+    def _enqueue(self, cls):
+        with self._lock:
+            if self._waiting[cls] >= self.queue:
+                self._reject(cls)
+            self._waiting[cls] += 1
+
+    def _dequeue(self, cls):
+        with self._lock:
+            self._waiting[cls] -= 1
+
+    def _hold(self, ident, n):
+        with self._lock:
+            self._holders[ident] = self._holders.get(ident, 0) + n
+            if not self._holders[ident]:
+                del self._holders[ident]
+
+    def _finish(self, cls, slot, start):
+        fcntl.flock(slot, fcntl.LOCK_UN)
+        slot.close()
+        seconds = time.time() - start
+        with self._lock:
+            self._seconds[cls] = 0.8 * self._seconds[cls] + 0.2 * seconds
+
+    @contextlib.contextmanager
+    def admit(self, cost):
+        """
+        Run the body once there's room for a request of this cost, or
+        raise Overloaded.
+        """
+        cls = self.classify(cost)
+        ident = threading.get_ident()
+        slot = self._take(cls)
+        if slot is None:
+            # If this thread already holds a slot, we're a greenlet
+            # sharing it with the holder, which can't finish while we
+            # sleep, so waiting would only stall the worker.
+            if ident in self._holders:
+                self._reject(cls)
+            self._enqueue(cls)
+            try:
+                deadline = time.time() + self.timeout
+                while slot is None:
+                    if time.time() >= deadline:
+                        self._reject(cls)
+                    time.sleep(POLL)
+                    slot = self._take(cls)
+            finally:
+                self._dequeue(cls)
+
+        self._hold(ident, 1)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._hold(ident, -1)
+            self._finish(cls, slot, start)
+
+    @contextlib.asynccontextmanager
+    async def admit_async(self, cost):
+        """
+        As admit(), without blocking the event loop while we wait.
+        """
+        cls = self.classify(cost)
+        slot = self._take(cls)
+        if slot is None:
+            self._enqueue(cls)
+            try:
+                deadline = time.time() + self.timeout
+                while slot is None:
+                    if time.time() >= deadline:
+                        self._reject(cls)
+                    await asyncio.sleep(POLL)
+                    slot = self._take(cls)
+            finally:
+                self._dequeue(cls)
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._finish(cls, slot, start)
@@ -3,104 +3,193 @@ Simple application to provide freq from images of seismic.
 Freq code by endolith https://gist.github.com/endolith/255291
 """
 from io import BytesIO
+import contextlib
+import os
+import time
 import uuid
 import base64
+import warnings
 
 from flask import Flask
 from flask import request, jsonify, render_template
 
-import requests
 import numpy as np
 from PIL import Image
 
+import admission
 import geophysics
-from segy import write_segy
+from segy import write_segy, SegyReader
 import utils
+import formats
+from cache import CACHE_DIR, SingleFlight
+from cache import ARRAY_DIR, ARRAY_MB, ArrayCache
 from errors import InvalidUsage
 
 application = Flask(__name__)
 
+# When this process started serving; gunicorn_conf.py fills in the rest.
+startup = {'time': time.time(), 'seconds': None}
+
+flight = SingleFlight(os.path.join(CACHE_DIR, 'flight'))
+arrays = ArrayCache(ARRAY_DIR, ARRAY_MB * 1024**2)
+gate = admission.AdmissionController()
+
+# SEG-Y DataSampleFormat codes for the segy_format parameter.
+SEGY_FORMATS = {'float': 5, 'ieee': 5, 'ibm': 1, 'int16': 3, 'int8': 8}
+
+# Frequency estimators for the method parameter.
+METHODS = {'auto': geophysics.freq_from_autocorr,
+           'fft':  geophysics.freq_from_fft,
+           'xing': geophysics.freq_from_crossings}
+
+# Content encodings for the segy_compress parameter.
+SEGY_COMPRESS = {'': None, 'none': None, 'false': None,
+                 'gzip': 'gzip', 'zstd': 'zstd'}
+
 
 @application.errorhandler(InvalidUsage)
 def handle_invalid_usage(error):
     response = jsonify(error.to_dict())
     response.status_code = error.status_code
+    if getattr(error, 'retry_after', None):
+        response.headers['Retry-After'] = str(error.retry_after)
     return response
 
 
 #
 # Seismic frequency and SEGY bot
 #
-@application.route('/freq')
-def freq():
-    # Params from inputs.
-    url = request.args.get('url')
-    b64 = request.args.get('image')
-    method = request.args.get('method') or 'xing'
-    avg = request.args.get('avg') or 'mean'
-    region = request.args.get('region')
-    ntraces = request.args.get('ntraces') or '10'
-    trace_spacing = request.args.get('trace_spacing') or 'regular'
-    bins = request.args.get('bins') or '11'
-    t_min = request.args.get('tmin') or '0'
-    t_max = request.args.get('tmax') or '1'
-    dt_param = request.args.get('dt') or 'auto'
+def get_params(args):
+    """
+    Parse and condition the analysis parameters from a request's args.
+    """
+    p = {}
+    p['url'] = args.get('url')
+    p['method'] = args.get('method') or 'xing'
+    p['avg'] = args.get('avg') or 'mean'
+    p['ntraces'] = int(args.get('ntraces') or '10')
+    p['trace_spacing'] = args.get('trace_spacing') or 'regular'
+    seed = args.get('seed')
+    p['seed'] = int(seed) if seed else None
+    p['bins'] = int(args.get('bins') or '11')
+    p['t_min'] = float(args.get('tmin') or '0')
+    p['t_max'] = float(args.get('tmax') or '1')
+    p['dt_param'] = args.get('dt') or 'auto'
+    p['resample'] = (args.get('resample') or 'image').lower()
+    p['segy_format'] = (args.get('segy_format') or 'float').lower()
+    p['segy_compress'] = (args.get('segy_compress') or '').lower()
+
+    region = args.get('region')
+    if region:
+        p['region'] = [int(n) for n in region.split(',')]
+    else:
+        p['region'] = []
 
     # Booleans.
-    spectrum = request.args.get('spectrum') or 'false'
-    segy = request.args.get('segy') or 'false'
-
     nope = {i: False for i in ('none', 'false', 'no', '0')}
+    for name in ('spectrum', 'segy', 'screen'):
+        value = args.get(name) or 'false'
+        p[name] = nope.get(value.lower(), True)
+
+    # Wavelet: zero phase, or constant phase from the data.
+    wavelet = (args.get('wavelet') or 'false').lower()
+    if wavelet in nope:
+        p['wavelet'] = None
+    elif wavelet == 'zero':
+        p['wavelet'] = 'zero'
+    else:
+        p['wavelet'] = 'constant'
+
+    # Bootstrap confidence level, in percent; true means 95.
+    ci = (args.get('ci') or 'false').lower()
+    if ci in nope:
+        p['ci'] = 0
+    elif ci in ('true', 'yes'):
+        p['ci'] = 95
+    else:
+        p['ci'] = float(ci)
+    p['nboot'] = int(args.get('nboot') or '1000')
+
+    return p
+
+
+def params_for(p, **kwargs):
+    """
+    The parameters we report back, from those get_params() found. Any
+    keyword arguments replace entries of p, e.g. a SEG-Y file's times.
+    """
+    p = dict(p, **kwargs)
+    return utils.build_params(p['method'], p['avg'],
+                              p['t_min'], p['t_max'], p['dt_param'],
+                              p['region'],
+                              p['trace_spacing'],
+                              url=p['url'])
+
+
+def resample_target(height, t_min, t_max, dt_param):
+    """
+    The sample interval and number of samples we resample an image of
+    this height to.
+    """
+    if dt_param[:4].lower() == 'orig':
+        dt = (t_max - t_min) / (height - 1)
+        target = height
+    elif dt_param[:4].lower() == 'auto':
+        dts = [0.0005, 0.001, 0.002, 0.004, 0.008]
+        for dt in sorted(dts, reverse=True):
+            target = int(1 + (t_max - t_min) / dt)
+            # Accept the first one that is larger than the current height.
+            if target >= height:
+                break  # dt and target are set
+    else:
+        dt = float(dt_param)
+        target = int((t_max - t_min) / dt)
+    return dt, target
 
-    spectrum = nope.get(spectrum.lower(), True)
-    segy = nope.get(segy.lower(), True)
 
-    # Condition or generate params.
-    ntraces = int(ntraces)
-    bins = int(bins)
-    t_min = float(t_min)
-    t_max = float(t_max)
-    uuid1 = str(uuid.uuid1())
-    if region:
-        region = [int(n) for n in region.split(',')]
-    else:
-        region = []
+def image_cost(content, p):
+    """
+    Estimate the cost of analysing an image from its header; PIL doesn't
+    decode the pixels until it has to. None if we can't tell.
+    """
+    try:
+        width, height = Image.open(BytesIO(content)).size
+    except Exception:
+        return None
 
-    # Fetch and crop image.
-    if url:
-        try:
-            r = requests.get(url)
-            im = Image.open(BytesIO(r.content))
-        except Exception:
-            payload = {'job_uuid': uuid1}
-            payload['parameters'] = utils.build_params(method, avg,
-                                                       t_min, t_max, dt_param,
-                                                       region,
-                                                       trace_spacing,
-                                                       url=url)
-            mess = 'Unable to open image from target URI.'
-            raise InvalidUsage(mess, status_code=410, payload=payload)
+    region = p['region']
+    if region and len(region) == 4:
+        width = max(region[2] - region[0], 1)
+        height = max(region[3] - region[1], 2)
 
-    elif b64:
-        try:
-            im = Image.open(BytesIO(base64.b64decode(b64)))
-        except Exception:
-            payload = {'job_uuid': uuid1}
-            payload['parameters'] = utils.build_params(method, avg,
-                                                       t_min, t_max, dt_param,
-                                                       region,
-                                                       trace_spacing,
-                                                       url=url)
-            mess = 'Could not decode payload image. Check base64 encoding.'
-            raise InvalidUsage(mess, status_code=410, payload=payload)
-    else:
+    try:
+        _, target = resample_target(height, p['t_min'], p['t_max'],
+                                    p['dt_param'])
+    except (ValueError, ZeroDivisionError):
+        return None
+
+    return admission.estimate_cost(width, height, target, p['ntraces'],
+                                   p['method'], p['segy'])
+
+
+def prepare_image(content, p, params, uuid1):
+    """
+    Decode, crop and resample the bytes of an image. Returns the array
+    of samples and a dict of what we found out about it.
+    """
+    url, region = p['url'], p['region']
+    t_min, t_max, dt_param = p['t_min'], p['t_max'], p['dt_param']
+
+    # Open and crop image.
+    try:
+        im = Image.open(BytesIO(content))
+    except Exception:
         payload = {'job_uuid': uuid1}
-        payload['parameters'] = utils.build_params(method, avg,
-                                                   t_min, t_max, dt_param,
-                                                   region,
-                                                   trace_spacing,
-                                                   url=url)
-        mess = 'You must provide an image.'
+        payload['parameters'] = params
+        if url:
+            mess = 'Unable to open image from target URI.'
+        else:
+            mess = 'Could not decode payload image. Check base64 encoding.'
         raise InvalidUsage(mess, status_code=410, payload=payload)
 
     if region:
@@ -113,20 +202,12 @@ def freq():
     width, height = im.size[0], im.size[1]
 
     # Calculate dt and interpolate if necessary.
-    if dt_param[:4].lower() == 'orig':
-        dt = (t_max - t_min) / (height - 1)
-    else:
-        if dt_param[:4].lower() == 'auto':
-            dts = [0.0005, 0.001, 0.002, 0.004, 0.008]
-            for dt in sorted(dts, reverse=True):
-                target = int(1 + (t_max - t_min) / dt)
-                # Accept the first one that is larger than the current height.
-                if target >= height:
-                    break  # dt and target are set
-        else:
-            dt = float(dt_param)
-            target = int((t_max - t_min) / dt)
-
+    dt, target = resample_target(height, t_min, t_max, dt_param)
+    if p['resample'] not in ('image', 'fft'):
+        mess = 'resample must be image or fft'
+        raise InvalidUsage(mess, status_code=410)
+    fft = p['resample'] == 'fft'
+    if dt_param[:4].lower() != 'orig' and not fft:
         # If dt is not orig, we need to inpterpolate.
         im = im.resize((width, target), Image.ANTIALIAS)
 
@@ -142,31 +223,259 @@ def freq():
     else:
         i = i
 
+    # Resample the traces, not the image.
+    if fft:
+        i = geophysics.resample_traces(i, target)
+
+    info = {'greyscale': grey,
+            'dt': dt,
+            'width': width,
+            'height': height,
+            'target': target,
+            }
+    return i, info
+
+
+def image_array(content, digest, p, params, uuid1):
+    """
+    The samples of an image and what we know about it, from the array
+    cache if any worker has already decoded it with these parameters.
+    """
+    region, dt_param = p['region'], p['dt_param']
+    t_min, t_max = p['t_min'], p['t_max']
+
+    key = utils.make_etag(digest, [region, t_min, t_max, dt_param,
+                                   p['resample']])
+    i, info = arrays.get(key)
+    if i is None:
+        i, info = prepare_image(content, p, params, uuid1)
+        try:
+            arrays.put(key, i, info)
+        except OSError:
+            print('Caching array failed')
+
+    return i, info
+
+
+def make_segy(i, dt, p):
+    """
+    Write the columns of an image as SEG-Y, compressed as requested.
+    Returns the bytes and their encoding, or (None, None) on failure.
+    """
+    try:
+        sample_format = SEGY_FORMATS[p['segy_format']]
+    except KeyError:
+        mess = 'segy_format must be one of {}'.format(
+            ', '.join(sorted(SEGY_FORMATS)))
+        raise InvalidUsage(mess, status_code=410)
+    encoding = SEGY_COMPRESS.get(p['segy_compress'], False)
+    if (encoding is False) or \
+       (encoding == 'zstd' and utils.zstandard is None):
+        mess = 'segy_compress must be gzip, zstd or none'
+        raise InvalidUsage(mess, status_code=410)
+
+    try:
+        # Compressed as it's written; no uncompressed copy.
+        databytes = BytesIO()
+        with utils.compressed_writer(databytes, encoding) as fo:
+            # Image columns are traces.
+            write_segy(i.T, fo, dt, p['t_min'],
+                       sample_format=sample_format)
+        databytes.seek(0)
+    except:
+        print('Write SEGY failed')
+        return None, None
+
+    return databytes, encoding
+
+
+def choose_traces(i, p):
+    """
+    The columns of an image to analyse, and how many were screened out,
+    or None if we didn't screen them.
+    """
+    traces = geophysics.get_trace_indices(i.shape[1], p['ntraces'],
+                                          p['trace_spacing'], p['seed'])
+    if p['screen']:
+        return geophysics.screen_traces(i, traces)
+    return traces, None
+
+
+def trace_plan(content, digest, p, params, uuid1):
+    """
+    The traces to analyse, as a matrix of samples, with what we know
+    about the image and how many traces were screened out. Also the
+    whole image, if we had to load it, or None.
+
+    The plan is cached per image and trace selection, with the counts of
+    the image's values for the histogram, so requests that only change
+    the method, averaging or outputs skip the image.
+    """
+    key = None
+    if (p['trace_spacing'] != 'random') or (p['seed'] is not None):
+        key = utils.make_etag(digest, [p['region'], p['t_min'], p['t_max'],
+                                       p['dt_param'], p['resample']],
+                              ntraces=p['ntraces'],
+                              spacing=p['trace_spacing'],
+                              seed=p['seed'], screen=p['screen'],
+                              plan=True)
+        x, info = arrays.get(key)
+        if x is not None:
+            return x, info, info['rejected'], None
+
+    i, info = image_array(content, digest, p, params, uuid1)
+    traces, rejected = choose_traces(i, p)
+    x = np.ascontiguousarray(i[:, traces])
+    counts = geophysics.value_counts(i)
+    info = dict(info, traces=traces.tolist(), rejected=rejected,
+                counts=None if counts is None else counts.tolist())
+    if key:
+        try:
+            arrays.put(key, x, info)
+        except OSError:
+            print('Caching trace plan failed')
+
+    return x, info, rejected, i
+
+
+def describe_image(info, rejected=None):
+    """
+    What we report about an image, from what prepare_image found.
+    """
+    d = {'greyscale': info['greyscale'],
+         'dt': info['dt'],
+         'img_size': {'original_height': info['height'],
+                      'width': info['width'],
+                      'resampled_height': info['target']},
+         }
+    if rejected is not None:
+        d['rejected_traces'] = rejected
+    return d
+
+
+def analyse_image(content, digest, p, params, uuid1):
+    """
+    Analyse the bytes of an image. Returns the result dict, with arrays
+    left as arrays for the response formatter.
+    """
+    t_min, t_max = p['t_min'], p['t_max']
+    segy = p['segy']
+
+    # The traces come from a cached plan; workers share decoded images
+    # through the array cache, and only SEG-Y needs one, or a histogram
+    # of an image the plan has no counts for.
+    x, info, rejected, i = trace_plan(content, digest, p, params, uuid1)
+    counts = info.get('counts')
+    if (i is None) and (segy or (p['bins'] and counts is None)):
+        i, _ = image_array(content, digest, p, params, uuid1)
+
     # Get SEGY file link, if requested.
+    file_link = ''
     if segy:
-        try:
-            databytes = BytesIO()
-            write_segy(i, databytes, dt, t_min)
-            databytes.seek(0)
-        except:
-            print('Write SEGY failed')
-        else:
-            file_link = utils.get_url(databytes, uuid1)
+        databytes, encoding = make_segy(i, info['dt'], p)
+        if databytes is not None:
+            file_link = utils.get_url(databytes, uuid1, encoding)
 
+    result = analyse_traces(x, np.arange(x.shape[1]), t_min, t_max,
+                            p, params, uuid1, image=i, counts=counts)
+    result['result'].update(describe_image(info, rejected))
+
+    if segy:
+        result['result']['segy'] = file_link
+
+    return result
+
+
+def analysis_key(digest, params, p):
+    """
+    A key for the result of analysing an image, or None if the analysis
+    isn't repeatable: the traces are random with no seed, or there's a
+    new SEGY file to link to.
+    """
+    if p['segy'] or (p['trace_spacing'] == 'random' and p['seed'] is None):
+        return None
+    return utils.make_etag(digest, params,
+                           ntraces=p['ntraces'], bins=p['bins'],
+                           spectrum=p['spectrum'], screen=p['screen'],
+                           ci=p['ci'], nboot=p['nboot'],
+                           resample=p['resample'], wavelet=p['wavelet'],
+                           seed=p['seed'])
+
+
+def analyse_segy(reader, p, uuid1, candidates=None):
+    """
+    Analyse traces read straight from a SEG-Y file, skipping the image
+    decode and resampling. Times come from the file's headers.
+
+    The traces are chosen from candidates, an array of trace numbers,
+    or from the whole file.
+    """
+    t_min, t_max = reader.t_min, reader.t_max
+    params = params_for(p, t_min=t_min, t_max=t_max, dt_param=reader.dt,
+                        region=[])
+
+    if candidates is None:
+        candidates = np.arange(reader.ntraces)
+    if candidates.size == 0:
+        payload = {'job_uuid': uuid1}
+        payload['parameters'] = params
+        mess = 'No traces match the inline, xline or cdp parameters.'
+        raise InvalidUsage(mess, status_code=410, payload=payload)
+
+    picks = geophysics.get_trace_indices(candidates.size,
+                                         p['ntraces'],
+                                         p['trace_spacing'],
+                                         p['seed'])
+
+    # A narrow selection gives repeated picks, which would count twice.
+    traces = candidates[np.unique(picks)]
+    i = reader.read_traces(traces).T
+
+    # Replacements would mean more reads, so bad traces are just dropped.
+    if p['screen']:
+        ok = geophysics.trace_quality(i, i.min(), i.max())
+        rejected = int((~ok).sum())
+        if ok.any():
+            traces, i = traces[ok], i[:, ok]
+    result = analyse_traces(i, np.arange(traces.size),
+                            t_min, t_max, p, params, uuid1)
+
+    result['result']['dt'] = reader.dt
+    result['result']['segy_size'] = {'ntraces': reader.ntraces,
+                                     'ns': reader.ns}
+    result['result']['traces'] = traces
+    if p['screen']:
+        result['result']['rejected_traces'] = rejected
+
+    return result
+
+
+def analyse_traces(i, traces, t_min, t_max, p, params, uuid1, image=None,
+                   counts=None):
+    """
+    Analyse some columns of an array of samples. Returns the result dict.
+    The histogram is of image, if given, or of the value counts of one,
+    or else of i.
+    """
     # Do analysis.
     print("Starting analysis")
-    m = {'auto': geophysics.freq_from_autocorr,
-         'fft':  geophysics.freq_from_fft,
-         'xing': geophysics.freq_from_crossings}
-    traces = geophysics.get_trace_indices(i.shape[1], ntraces, trace_spacing)
-    specs, f_list, p_list, snr_list, mis, mas = geophysics.analyse(i,
-                                                                   t_min,
-                                                                   t_max,
-                                                                   traces,
-                                                                   m[method])
-
+    lists = geophysics.analyse(i, t_min, t_max, traces, METHODS[p['method']])
     print("Finished analysis")
 
+    return summarise(i, lists, t_min, t_max, p, params, uuid1, image, counts)
+
+
+def summarise(i, lists, t_min, t_max, p, params, uuid1, image=None,
+              counts=None):
+    """
+    The result dict, from the per-trace lists made by geophysics.analyse.
+    """
+    avg = p['avg']
+    bins, spectrum = p['bins'], p['spectrum']
+    ci, nboot = p['ci'], p['nboot']
+    wavelet = p['wavelet']
+    specs, f_list, p_list, snr_list, mis, mas = lists
+
     # Compute statistics.
     print("***** f_list:", f_list)
 
@@ -194,6 +503,16 @@ def freq():
     snrsd = np.nanstd(snr_list)
     snr = np.nanmean(snr_list)
 
+    # Confidence intervals, resampling the per-trace results.
+    if ci:
+        if not (0 < ci < 100) or not (10 <= nboot <= 10000):
+            mess = 'ci must be between 0 and 100, nboot 10 to 10000'
+            raise InvalidUsage(mess, status_code=410)
+        trim = 0.2 if avg.lower() == 'trim' else 0
+        f_ci = geophysics.bootstrap_ci(f_list, ci, nboot, trim)
+        p_ci = geophysics.bootstrap_ci(p_list, ci, nboot, trim)
+        snr_ci = geophysics.bootstrap_ci(snr_list, ci, nboot)
+
     # Spectrum.
     print("Starting spectrum")
 
@@ -208,17 +527,21 @@ def freq():
 
         # Probably the image is not greyscale.
         payload = {'job_uuid': uuid1}
-        payload['parameters'] = utils.build_params(method, avg,
-                                                   t_min, t_max, dt_param,
-                                                   region,
-                                                   trace_spacing,
-                                                   url=url)
+        payload['parameters'] = params
         mess = 'Analysis error. Probably the colorbar is not greyscale.'
         raise InvalidUsage(mess, status_code=410, payload=payload)
 
+    # Wavelet, from the spectrum and phase we already have.
+    if wavelet:
+        phase = 0 if wavelet == 'zero' else np.nan_to_num(p)
+        t, w = geophysics.wavelet_from_spectrum(spec, i.shape[0], 1/fs,
+                                                phase)
+
     # Histogram.
-    if bins:
-        hist = np.histogram(i, bins=bins)
+    if bins and (image is None) and (counts is not None):
+        hist = geophysics.histogram_from_counts(counts, bins)
+    elif bins:
+        hist = np.histogram(i if image is None else image, bins=bins)
     else:
         hist = None
 
@@ -238,31 +561,320 @@ def freq():
                                  'n': pn}
     result['result']['snr'] = {'avg': np.round(snr, 2),
                                'sd': np.round(snrsd, 2)}
-    result['result']['greyscale'] = grey
-    result['result']['dt'] = dt
-    result['result']['img_size'] = {'original_height': height,
-                                    'width': width,
-                                    'resampled_height': target}
 
-    if segy:
-        result['result']['segy'] = file_link
+    if ci:
+        result['result']['freq']['ci'] = np.round(f_ci, 2)
+        result['result']['phase']['ci'] = np.round(p_ci, 2)
+        result['result']['snr']['ci'] = np.round(snr_ci, 2)
+        result['result']['ci'] = {'level': ci, 'nboot': nboot}
+
+    if wavelet:
+        result['result']['wavelet'] = {'time': t,
+                                       'amplitude': w,
+                                       'phase': np.round(phase, 2)}
 
     if spectrum:
-        result['result']['spectrum'] = spec.tolist()
-        result['result']['frequencies'] = freq.tolist()
+        result['result']['spectrum'] = spec
+        result['result']['frequencies'] = freq
 
     if hist:
-        result['result']['histogram'] = {'counts': hist[0].tolist(),
-                                         'bins':  hist[1].tolist()
+        result['result']['histogram'] = {'counts': hist[0],
+                                         'bins':  hist[1]
                                          }
 
-    result['parameters'] = utils.build_params(method, avg,
-                                              t_min, t_max, dt_param,
-                                              region,
-                                              trace_spacing,
-                                              url=url)
+    result['parameters'] = params
+
+    return result
+
+
+def running_stats(lists, avg, done, total):
+    """
+    Statistics so far, from the per-trace lists, for progress reports.
+    """
+    def average(x):
+        if avg.lower() == 'trim' and len(x) > 4:
+            return geophysics.trim_mean(x, 0.2)
+        return np.nanmean(x) if x else np.nan
+
+    _, f_list, p_list, snr_list, _, _ = lists
+    return {'done': done,
+            'total': total,
+            'freq': {'peak': np.round(average(f_list), 2),
+                     'sd': np.round(np.nanstd(f_list), 2),
+                     'n': len(f_list)},
+            'phase': {'avg': np.round(average(p_list), 2),
+                      'sd': np.round(np.nanstd(p_list), 2),
+                      'n': len(p_list)},
+            'snr': {'avg': np.round(np.nanmean(snr_list), 2),
+                    'sd': np.round(np.nanstd(snr_list), 2)},
+            }
+
+
+def stream_image(content, digest, p, params, uuid1, batch=10):
+    """
+    Analyse an image, yielding (event, data) as each stage finishes: what
+    we know about the image, running statistics after every batch of
+    traces, then the same result /freq gives.
+    """
+    t_min, t_max = p['t_min'], p['t_max']
+    method = METHODS[p['method']]
+
+    x, info, rejected, i = trace_plan(content, digest, p, params, uuid1)
+    described = describe_image(info, rejected)
+    yield 'meta', dict(described, job_uuid=uuid1,
+                       traces=info['traces'], parameters=params)
+
+    n_traces = x.shape[1]
+    batches = geophysics.iter_analyse(x, t_min, t_max, np.arange(n_traces),
+                                      method, batch)
+    for n, lists in enumerate(batches, 1):
+        done = min(n * batch, n_traces)
+        yield 'progress', running_stats(lists, p['avg'], done, n_traces)
+
+    counts = info.get('counts')
+    if (i is None) and p['bins'] and (counts is None):
+        i, _ = image_array(content, digest, p, params, uuid1)
+    result = summarise(x, lists, t_min, t_max, p, params, uuid1, image=i,
+                       counts=counts)
+    result['result'].update(described)
+    yield 'result', result
+
+
+def image_content(url, b64, params, uuid1):
+    """
+    The bytes of a request's image, from its URL or base64, and their
+    digest.
+    """
+    # Concurrent fetches of one URL share a download.
+    if url:
+        try:
+            return flight.do('fetch:' + url, lambda: utils.fetch_url(url),
+                             share=False)
+        except Exception:
+            payload = {'job_uuid': uuid1}
+            payload['parameters'] = params
+            mess = 'Unable to open image from target URI.'
+            raise InvalidUsage(mess, status_code=410, payload=payload)
+
+    if b64:
+        try:
+            content = base64.b64decode(b64)
+        except Exception:
+            content = b''
+        return content, utils.hash_bytes(content)
+
+    payload = {'job_uuid': uuid1}
+    payload['parameters'] = params
+    mess = 'You must provide an image.'
+    raise InvalidUsage(mess, status_code=410, payload=payload)
+
+
+#
+# Seismic frequency and SEGY bot
+#
+@application.route('/freq', methods=['GET', 'POST'])
+def freq():
+    p = get_params(request.values)
+    b64 = request.values.get('image')
+    segy_url = request.values.get('segy_url')
+    segy_file = request.files.get('segyfile')
+    fmt = formats.negotiate(request)
+    uuid1 = str(uuid.uuid1())
+    url = p['url']
+
+    if segy_url or segy_file:
+        return freq_segy(segy_url, segy_file, p, fmt, uuid1)
+
+    params = params_for(p)
+    content, digest = image_content(url, b64, params, uuid1)
+
+    # The same image and parameters give the same analysis, though not
+    # the same bytes (job_uuid, compression), so the ETag is weak.
+    etag = None
+    key = analysis_key(digest, params, p)
+    if key:
+        etag = utils.make_etag(key, params, fmt=fmt)
+        if request.if_none_match.contains_weak(etag):
+            response = application.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
+    # Shed load rather than queue behind expensive work.
+    cost = image_cost(content, p)
+
+    def work():
+        with gate.admit(cost):
+            return analyse_image(content, digest, p, params, uuid1)
+
+    if key:
+        # Identical requests in flight share one analysis.
+        result = flight.do('analyse:' + key, work)
+        result = dict(result, job_uuid=uuid1)  # Not the leader's.
+    else:
+        result = work()
+
+    response = formats.make_response(result, fmt, request)
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def fetch_segy(url):
+    """
+    A SEG-Y file from a URL, downloaded to the cache and open for
+    mapping. Concurrent requests for one URL share the download.
+    """
+    opened = []
+
+    def fetch():
+        digest, f = utils.fetch_file(url)
+        opened.append(f)
+        return digest
+
+    # Only the digest goes through the flight, never the bytes.
+    digest = flight.do('fetch:' + url, fetch, share=False)
+    if opened:
+        return opened[0]
+    path = utils.cached_path(digest)
+    if path:
+        try:
+            return open(path, 'rb')
+        except OSError:
+            pass
+    return utils.fetch_file(url)[1]  # Evicted already.
+
+
+def freq_segy(segy_url, segy_file, p, fmt, uuid1):
+    """
+    Analyse SEG-Y from a URL or an upload, memory-mapped where we can.
+    """
+    try:
+        if segy_url:
+            p['url'] = segy_url
+            with fetch_segy(segy_url) as f:
+                reader = SegyReader(f)
+                reader.path = f.name  # Keep its index in the cache.
+        else:
+            # Big uploads are spooled to a temporary file we can map.
+            try:
+                segy_file.stream.fileno()
+                reader = SegyReader(segy_file.stream)
+            except (AttributeError, OSError):
+                reader = SegyReader(segy_file.read())
+    except Exception:
+        payload = {'job_uuid': uuid1}
+        mess = 'Unable to read SEG-Y.'
+        raise InvalidUsage(mess, status_code=410, payload=payload)
+
+    # Select traces by header, using the index.
+    try:
+        inline = utils.parse_range(request.values.get('inline'))
+        xlines = utils.parse_range(request.values.get('xline'))
+        cdps = utils.parse_range(request.values.get('cdp'))
+    except ValueError as e:
+        raise InvalidUsage(str(e), status_code=410)
+
+    if inline and (inline[0] != inline[1]):
+        mess = 'inline must be a single line number.'
+        raise InvalidUsage(mess, status_code=410)
+
+    # Only the traces we pick are read, but the index reads every header.
+    width = min(p['ntraces'], reader.ntraces)
+    cost = admission.estimate_cost(width, reader.ns, reader.ns,
+                                   p['ntraces'], p['method'], False)
+    if cdps or inline:
+        cost += reader.ntraces / 1e6
+
+    with gate.admit(cost):
+        candidates = None
+        if cdps:
+            candidates = reader.index().lookup(cdps=cdps)
+        elif inline:
+            candidates = reader.index().lookup(inline=inline[0],
+                                               xlines=xlines)
+        result = analyse_segy(reader, p, uuid1, candidates)
+
+    return formats.make_response(result, fmt, request)
+
+
+@application.route('/freq/stream', methods=['GET', 'POST'])
+def freq_stream():
+    """
+    /freq for images, streamed as Server-Sent Events or NDJSON.
+    """
+    p = get_params(request.values)
+    fmt = formats.negotiate_stream(request)
+    uuid1 = str(uuid.uuid1())
+
+    if request.values.get('segy_url') or request.files.get('segyfile'):
+        mess = 'Streaming is only available for images.'
+        raise InvalidUsage(mess, status_code=410)
+
+    params = params_for(p)
+    content, digest = image_content(p['url'], request.values.get('image'),
+                                    params, uuid1)
+
+    # Hold our admission slot until the response is closed, which the
+    # server does when we finish or the client goes away.
+    admitted = gate.admit(image_cost(content, p))
+    admitted.__enter__()
+    try:
+        # Decode errors are better as a status code than as an event.
+        events = stream_image(content, digest, p, params, uuid1)
+        first = next(events)
+    except BaseException:
+        admitted.__exit__(None, None, None)
+        raise
+
+    def generate():
+        yield formats.encode_event(*first, fmt=fmt)
+        try:
+            for event in events:
+                yield formats.encode_event(*event, fmt=fmt)
+        except InvalidUsage as error:
+            yield formats.encode_event('error', error.to_dict(), fmt=fmt)
+
+    response = application.response_class(generate(),
+                                          mimetype=formats.MIMETYPES[fmt])
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(lambda: admitted.__exit__(None, None, None))
+    return response
+
 
-    return jsonify(result)
+def warm_up():
+    """
+    Run a tiny image through the pipeline, so the first real request
+    doesn't pay to load PIL's decoders and set up NumPy's FFT. Call it
+    before forking workers, so they all share the result.
+    """
+    t = np.linspace(0, 1, 64)
+    a = 128 + 100 * np.sin(2 * np.pi * 25 * t)[:, None] * np.ones(32)
+    im = Image.fromarray(a.astype(np.uint8))
+    p = get_params({'ntraces': '2', 'bins': '0'})
+    params = params_for(p)
+    with contextlib.redirect_stdout(None), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for fmt in ('PNG', 'JPEG', 'GIF'):
+            b = BytesIO()
+            im.save(b, fmt)
+            i, info = prepare_image(b.getvalue(), p, params, '')
+        for method in METHODS:
+            p['method'] = method
+            analyse_traces(i, np.array([8, 16]), 0, 1, p, params, '')
+
+
+@application.route('/status')
+def status():
+    """
+    For health checks and autoscaling.
+    """
+    return jsonify({'pid': os.getpid(),
+                    'uptime': round(time.time() - startup['time'], 1),
+                    'startup_seconds': startup['seconds'],
+                    'rss_mb': round(utils.rss_mb(), 1),
+                    'admission': gate.stats(),
+                    })
 
 
 @application.route('/')
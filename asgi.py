@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+ASGI entry point for ageobot, alongside the WSGI `application` in app.py.
+
+Run it with, for example:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 80
+
+/freq requests for images fetch the image with non-blocking I/O and send
+the decode, resampling and analysis to a bounded pool, so one worker can
+have many requests in flight. SEG-Y uploads to S3 run in a separate I/O
+pool. Everything else, including SEG-Y input, runs the WSGI app in a
+thread, sending its response as it comes, so /freq/stream streams. Both
+paths go through the same admission control; see admission.py.
+
+Environment:
+
+    FREQBOT_EXECUTOR     'thread' (default) or 'process', for CPU work.
+    FREQBOT_CPU_WORKERS  Size of the CPU pool, default the number of CPUs.
+    FREQBOT_IO_WORKERS   Size of the I/O pool, default 32.
+
+It needs the packages in requirements-asgi.txt as well.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import asyncio
+import base64
+import functools
+import os
+import sys
+import tempfile
+import uuid
+
+import httpx
+
+import app as wsgi
+import formats
+import utils
+from errors import InvalidUsage
+
+
+EXECUTOR = os.environ.get('FREQBOT_EXECUTOR', 'thread')
+CPU_WORKERS = int(os.environ.get('FREQBOT_CPU_WORKERS', os.cpu_count() or 1))
+IO_WORKERS = int(os.environ.get('FREQBOT_IO_WORKERS', '32'))
+
+# Request bodies bigger than this, in bytes, are spooled to disk.
+BODY_MEMORY = 1024 * 1024
+
+if EXECUTOR == 'process':
+    cpu_pool = ProcessPoolExecutor(max_workers=CPU_WORKERS)
+else:
+    cpu_pool = ThreadPoolExecutor(max_workers=CPU_WORKERS)
+io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS)
+
+_client = None
+_fetching = {}
+_analysing = {}
+
+
+def _run(pool, func, *args):
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(pool, functools.partial(func, *args))
+
+
+#
+# Work done in the pools. Module-level so a process pool can pickle it.
+#
+def _analyse(key, content, digest, p, params, uuid1):
+    """
+    Analyse without the SEG-Y step, which we do separately.
+    """
+    p = dict(p, segy=False)
+    if key:
+        result = wsgi.flight.do('analyse:' + key,
+                                lambda: wsgi.analyse_image(content, digest,
+                                                           p, params, uuid1))
+        return dict(result, job_uuid=uuid1)  # Not the leader's.
+    return wsgi.analyse_image(content, digest, p, params, uuid1)
+
+
+def _segy(content, digest, p, params, uuid1):
+    i, info = wsgi.image_array(content, digest, p, params, uuid1)
+    return wsgi.make_segy(i, info['dt'], p)
+
+
+async def _call_wsgi(environ, send):
+    """
+    Run the WSGI app on a request and send its response as it comes, so
+    streamed responses stream. Each step of the body runs in the I/O
+    pool.
+    """
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+
+    body = await _run(io_pool, wsgi.application, environ, start_response)
+    try:
+        chunks = iter(body)
+        status, headers = started
+        headers = [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                   for k, v in headers]
+        await send({'type': 'http.response.start',
+                    'status': int(status.split()[0]),
+                    'headers': headers})
+        while True:
+            chunk = await _run(io_pool, next, chunks, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body',
+                            'body': chunk,
+                            'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(body, 'close'):
+            await _run(io_pool, body.close)
+
+
+#
+# Non-blocking fetch, through the shared disk cache.
+#
+async def _fetch(url):
+    meta, headers = utils.validators(url)
+    r = await _client.get(url, headers=headers)
+    if headers and r.status_code == 304:
+        content = utils.cached_content(meta['digest'])
+        if content is not None:
+            return content, meta['digest']
+        r = await _client.get(url)  # Evicted since we looked.
+    r.raise_for_status()
+
+    digest = await _run(io_pool, utils.remember, url, r.content, r.headers)
+    return r.content, digest
+
+
+async def fetch_url(url):
+    """
+    Concurrent fetches of one URL share a download.
+    """
+    task = _fetching.get(url)
+    if task is None:
+        task = asyncio.ensure_future(_fetch(url))
+        _fetching[url] = task
+        task.add_done_callback(lambda t: _fetching.pop(url, None))
+    return await asyncio.shield(task)
+
+
+async def _admit_analyse(cost, key, content, digest, p, params, uuid1):
+    # Admission is decided here, so waiting requests don't hold a pool
+    # worker.
+    async with wsgi.gate.admit_async(cost):
+        return await _run(cpu_pool, _analyse,
+                          key, content, digest, p, params, uuid1)
+
+
+async def analyse(cost, key, content, digest, p, params, uuid1):
+    """
+    Concurrent requests for one analysis share a task, and only that task
+    asks for admission.
+    """
+    if not key:
+        return await _admit_analyse(cost, key, content, digest,
+                                    p, params, uuid1)
+    task = _analysing.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_admit_analyse(cost, key, content,
+                                                    digest, p, params, uuid1))
+        _analysing[key] = task
+        task.add_done_callback(lambda t: _analysing.pop(key, None))
+    result = await asyncio.shield(task)
+    return dict(result, job_uuid=uuid1)  # Not the leader's.
+
+
+async def freq(req):
+    """
+    The /freq endpoint for images.
+    """
+    p = wsgi.get_params(req.values)
+    b64 = req.values.get('image')
+    fmt = formats.negotiate(req)
+    uuid1 = str(uuid.uuid1())
+    url = p['url']
+
+    params = wsgi.params_for(p)
+
+    if url:
+        try:
+            content, digest = await fetch_url(url)
+        except Exception:
+            payload = {'job_uuid': uuid1}
+            payload['parameters'] = params
+            mess = 'Unable to open image from target URI.'
+            raise InvalidUsage(mess, status_code=410, payload=payload)
+    else:
+        try:
+            content = base64.b64decode(b64)
+        except Exception:
+            content = b''
+        digest = utils.hash_bytes(content)
+
+    etag = None
+    key = wsgi.analysis_key(digest, params, p)
+    if key:
+        etag = utils.make_etag(key, params, fmt=fmt)
+        if req.if_none_match.contains_weak(etag):
+            response = wsgi.application.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
+    # The header parse is cheap enough to do on the loop.
+    cost = wsgi.image_cost(content, p)
+    if p['segy']:
+        async with wsgi.gate.admit_async(cost):
+            result = await _run(cpu_pool, _analyse,
+                                key, content, digest, p, params, uuid1)
+            databytes, encoding = await _run(cpu_pool, _segy, content,
+                                             digest, p, params, uuid1)
+    else:
+        result = await analyse(cost, key, content, digest, p, params, uuid1)
+
+    if p['segy']:
+        file_link = ''
+        if databytes is not None:
+            file_link = await _run(io_pool, utils.get_url,
+                                   databytes, uuid1, encoding)
+        result['result']['segy'] = file_link
+
+    with wsgi.application.app_context():
+        response = formats.make_response(result, fmt, req)
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+#
+# ASGI plumbing.
+#
+def _environ(scope, body):
+    """
+    A WSGI environ for an ASGI HTTP scope, reading the body from a file.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {'REQUEST_METHOD': scope['method'],
+               'SCRIPT_NAME': scope.get('root_path', ''),
+               'PATH_INFO': scope['path'],
+               'QUERY_STRING': scope['query_string'].decode('latin-1'),
+               'SERVER_NAME': server[0],
+               'SERVER_PORT': str(server[1]),
+               'SERVER_PROTOCOL': 'HTTP/' + scope['http_version'],
+               'wsgi.version': (1, 0),
+               'wsgi.url_scheme': scope.get('scheme', 'http'),
+               'wsgi.input': body,
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': True,
+               'wsgi.multiprocess': True,
+               'wsgi.run_once': False,
+               }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+async def _send(send, status, headers, body):
+    headers = [(k.lower().encode('latin-1'), v.encode('latin-1'))
+               for k, v in headers]
+    await send({'type': 'http.response.start',
+                'status': status,
+                'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _lifespan(receive, send):
+    global _client
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            wsgi.warm_up()
+            _client = httpx.AsyncClient(follow_redirects=True)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await _client.aclose()
+            cpu_pool.shutdown(wait=False)
+            io_pool.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(follow_redirects=True)
+
+    # Big bodies, like SEG-Y uploads, go to disk, as they would under
+    # gunicorn, so the form parser can spool them and we can map them.
+    with tempfile.SpooledTemporaryFile(max_size=BODY_MEMORY) as body:
+        while True:
+            message = await receive()
+            body.write(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        body.seek(0)
+        await _handle(scope, _environ(scope, body), send)
+
+
+async def _handle(scope, environ, send):
+    """
+    Serve image /freq GETs natively, and everything else through WSGI.
+    """
+    req = wsgi.application.request_class(environ)
+    fast = (scope['path'] == '/freq') and (scope['method'] == 'GET') and \
+        (req.args.get('url') or req.args.get('image')) and \
+        not req.args.get('segy_url')
+
+    if not fast:
+        return await _call_wsgi(environ, send)
+
+    try:
+        response = await freq(req)
+    except InvalidUsage as error:
+        with wsgi.application.app_context():
+            response = wsgi.handle_invalid_usage(error)
+    await _send(send, response.status_code,
+                response.headers.items(), response.get_data())
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Analyse directories of images offline, with the same pipeline as /freq.
+
+    python batch.py sections/ -o results.jsonl --tmax 3 --workers 8
+    python batch.py --manifest manifest.csv -o results.csv
+
+Inputs are image files, directories (searched recursively) or a manifest.
+A manifest is a text file with one path per line, or a CSV file with a
+`path` column and any other /freq parameters as columns, to override the
+command line for that image.
+
+Results go to CSV, JSONL or Parquet, chosen by the output's extension.
+Each result is written as soon as it's done, so an interrupted run loses
+nothing it finished; run it again with the same output and it carries on
+where it left off. Failures may have been transient (memory, I/O), so a
+run drops them from the output first and tries those images again.
+Parquet can't be appended to, so we keep a JSONL journal next to it and
+convert it at the end.
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+
+import numpy as np
+
+import app
+import utils
+from errors import InvalidUsage
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff')
+
+# The /freq parameters we take on the command line.
+PARAMS = ('method', 'avg', 'ntraces', 'trace_spacing', 'bins',
+          'tmin', 'tmax', 'dt', 'resample', 'region', 'spectrum',
+          'seed', 'screen', 'ci', 'nboot', 'wavelet')
+
+# CSV columns. JSONL and Parquet get everything in the result.
+COLUMNS = ['path', 'digest', 'status', 'message', 'seconds',
+           'freq.peak', 'freq.sd', 'freq.n', 'freq.min', 'freq.max',
+           'phase.avg', 'phase.sd', 'phase.n',
+           'snr.avg', 'snr.sd',
+           'greyscale', 'dt',
+           'img_size.width', 'img_size.original_height',
+           'img_size.resampled_height',
+           'rejected_traces',
+           ]
+
+
+def find_images(inputs):
+    """
+    Image files in some files and directories, in a repeatable order.
+    """
+    for path in inputs:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(EXTENSIONS):
+                    yield os.path.join(root, name)
+
+
+def read_manifest(path):
+    """
+    (path, parameters) for each image in a manifest.
+    """
+    with open(path, newline='') as f:
+        if path.lower().endswith('.csv'):
+            for row in csv.DictReader(f):
+                image = row.pop('path')
+                yield image, {k: v for k, v in row.items() if v}
+        else:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    yield line, {}
+
+
+def flatten(obj, prefix=''):
+    """
+    A nested result dict as one level of dotted names.
+    """
+    flat = {}
+    for k, v in obj.items():
+        name = prefix + k
+        if isinstance(v, dict):
+            flat.update(flatten(v, name + '.'))
+        elif isinstance(v, np.ndarray):
+            flat[name] = v.tolist()
+        elif isinstance(v, np.generic):
+            flat[name] = v.item()
+        else:
+            flat[name] = v
+        # JSON has no NaN.
+        if isinstance(flat.get(name), float) and np.isnan(flat[name]):
+            flat[name] = None
+    return flat
+
+
+def analyse_file(task):
+    """
+    Analyse one image. Runs in a worker; never raises.
+    """
+    path, args = task
+    record = {'path': path}
+    start = time.time()
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest = utils.hash_bytes(content)
+        record['digest'] = digest
+        p = app.get_params(args)
+        uuid1 = str(uuid.uuid1())
+        params = app.params_for(p)
+
+        # Each image is seen once, so skip the shared caches the web
+        # workers use and decode it here.
+        i, info = app.prepare_image(content, p, params, uuid1)
+        traces, rejected = app.choose_traces(i, p)
+        result = app.analyse_traces(i, traces, p['t_min'], p['t_max'],
+                                    p, params, uuid1)
+        result['result'].update(app.describe_image(info, rejected))
+        record.update(flatten(result['result']))
+        record['status'] = 'success'
+        record['message'] = ''
+    except InvalidUsage as e:
+        record['status'] = 'error'
+        record['message'] = e.message
+    except Exception as e:
+        record['status'] = 'error'
+        record['message'] = '{}: {}'.format(type(e).__name__, e)
+    record['seconds'] = round(time.time() - start, 3)
+    return record
+
+
+def _quiet():
+    # The pipeline prints progress for the web logs; we don't want it.
+    sys.stdout = open(os.devnull, 'w')
+
+
+def _truncate_partial(path):
+    """
+    Drop a half-written last line, left by a crash.
+    """
+    with open(path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end != len(data):
+            f.truncate(end)
+
+
+class Writer(object):
+    """
+    Append records to CSV or JSONL, one line each, flushed as we go.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.csv = path.lower().endswith('.csv')
+        new = not os.path.exists(path) or not os.path.getsize(path)
+        if not new:
+            _truncate_partial(path)
+            self._drop_failures()
+        self.f = open(path, 'a', newline='')
+        if self.csv:
+            self.writer = csv.DictWriter(self.f, COLUMNS,
+                                         extrasaction='ignore')
+            if new:
+                self.writer.writeheader()
+
+    def _read(self):
+        with open(self.path, newline='') as f:
+            if self.csv:
+                return list(csv.DictReader(f))
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _drop_failures(self):
+        """
+        Rewrite the output without the records of images that failed.
+        """
+        records = self._read()
+        keep = [r for r in records if r['status'] == 'success']
+        if len(keep) == len(records):
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', newline='') as f:
+            if self.csv:
+                writer = csv.DictWriter(f, COLUMNS, extrasaction='ignore')
+                writer.writeheader()
+                writer.writerows(keep)
+            else:
+                f.writelines(json.dumps(r) + '\n' for r in keep)
+        os.replace(tmp, self.path)
+
+    def done(self):
+        """
+        The paths already in the output, all of them successes.
+        """
+        return {r['path'] for r in self._read()}
+
+    def write(self, record):
+        if self.csv:
+            self.writer.writerow(record)
+        else:
+            self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def to_parquet(journal, path):
+    with open(journal) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    # Failed images have fewer fields, so take the columns from all the
+    # records, not the first.
+    names = []
+    for record in records:
+        names += [k for k in record if k not in names]
+    table = pyarrow.Table.from_pydict({k: [r.get(k) for r in records]
+                                       for k in names})
+    pyarrow.parquet.write_table(table, path)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='*',
+                        help='image files or directories')
+    parser.add_argument('--manifest', help='file listing the images')
+    parser.add_argument('-o', '--output', required=True,
+                        help='results file: .csv, .jsonl or .parquet')
+    parser.add_argument('--workers', type=int,
+                        default=os.cpu_count() or 1,
+                        help='processes to use (default: one per CPU)')
+    parser.add_argument('--verbose', action='store_true',
+                        help="show the pipeline's progress messages")
+    for name in PARAMS:
+        parser.add_argument('--' + name.replace('_', '-'), dest=name,
+                            help='as the /freq parameter')
+    args = parser.parse_args(argv)
+    if not (args.inputs or args.manifest):
+        parser.error('give some images, directories or a --manifest')
+    if args.output.lower().endswith('.parquet') and pyarrow is None:
+        parser.error('Parquet output needs pyarrow')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    defaults = {k: getattr(args, k) for k in PARAMS
+                if getattr(args, k) is not None}
+
+    tasks = [(path, {}) for path in find_images(args.inputs)]
+    if args.manifest:
+        tasks += list(read_manifest(args.manifest))
+
+    parquet = args.output.lower().endswith('.parquet')
+    journal = args.output + '.jsonl' if parquet else args.output
+    writer = Writer(journal)
+    done = writer.done()
+    todo = [(path, dict(defaults, **params))
+            for path, params in tasks if path not in done]
+    print('{} images, {} done already'.format(len(tasks), len(tasks) -
+                                              len(todo)))
+
+    init = None if args.verbose else _quiet
+    errors = 0
+    with multiprocessing.Pool(args.workers, initializer=init,
+                              maxtasksperchild=100) as pool:
+        try:
+            results = pool.imap_unordered(analyse_file, todo)
+            for n, record in enumerate(results, 1):
+                writer.write(record)
+                if record['status'] != 'success':
+                    errors += 1
+                    print('{}: {}'.format(record['path'], record['message']))
+                if not n % 100:
+                    print('{} of {}'.format(n, len(todo)))
+        finally:
+            writer.close()
+
+    if parquet:
+        to_parquet(journal, args.output)
+    print('Finished {} images, {} errors'.format(len(todo), errors))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk caches and request coalescing for ageobot.
+
+Everything is written to a temporary file and moved into place, so the
+gunicorn workers can share a cache directory without locking it: readers
+see either the old file or the new one, never half of one.
+
+"""
+from io import BytesIO
+import fcntl
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+
+# Shared by all workers in a container. Override in the environment.
+CACHE_DIR = os.environ.get('FREQBOT_CACHE_DIR',
+                           os.path.join(tempfile.gettempdir(), 'freqbot'))
+CACHE_MB = int(os.environ.get('FREQBOT_CACHE_MB', '512'))
+
+# Decoded arrays are best kept in RAM, so prefer /dev/shm if we have it.
+if os.path.isdir('/dev/shm'):
+    _array_dir = os.path.join('/dev/shm', 'freqbot')
+else:
+    _array_dir = os.path.join(CACHE_DIR, 'arrays')
+ARRAY_DIR = os.environ.get('FREQBOT_ARRAY_DIR', _array_dir)
+ARRAY_MB = int(os.environ.get('FREQBOT_ARRAY_MB', '256'))
+
+
+def _key(s):
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+
+def atomic_write(path, data):
+    """
+    Write bytes to path so that nobody sees a partial file.
+    """
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class DiskCache(object):
+    """
+    A directory of files, bounded in size, evicting the least recently
+    used. Content is stored by its own hash, so several keys can share
+    one file; small JSON files map keys to content and metadata. They
+    count towards the budget and are evicted like the content.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _meta_path(self, key):
+        return os.path.join(self.directory, _key(key) + '.json')
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest + '.bin')
+
+    def get_meta(self, key):
+        """
+        Metadata for a key, or None if we don't have it.
+        """
+        path = self._meta_path(key)
+        try:
+            with open(path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self.touch(path)
+        return meta
+
+    def forget(self, key):
+        """
+        Drop the metadata for a key, e.g. when its content has gone.
+        """
+        try:
+            os.remove(self._meta_path(key))
+        except OSError:
+            pass
+
+    def read(self, digest):
+        """
+        Content for a digest, or None if it has been evicted.
+        """
+        path = self.path(digest)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except OSError:
+            return None
+        self.touch(path)
+        return content
+
+    def touch(self, path):
+        """
+        Mark a file as recently used.
+        """
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def put(self, key, digest, content, meta):
+        """
+        Store content and its metadata under key.
+        """
+        meta = dict(meta, digest=digest, size=len(content))
+        if not os.path.exists(self.path(digest)):
+            atomic_write(self.path(digest), content)
+        else:
+            self.touch(self.path(digest))
+        atomic_write(self._meta_path(key), json.dumps(meta).encode('utf-8'))
+        self.evict()
+
+    def put_file(self, key, digest, tmp, meta):
+        """
+        As put(), for content already in a temporary file in the cache
+        directory, which is moved into place. Returns the content, open
+        for reading, so it can still be read if it's evicted at once.
+        """
+        path = self.path(digest)
+        meta = dict(meta, digest=digest, size=os.path.getsize(tmp))
+        os.replace(tmp, path)
+        f = open(path, 'rb')
+        atomic_write(self._meta_path(key), json.dumps(meta).encode('utf-8'))
+        self.evict()
+        return f
+
+    def evict(self):
+        """
+        Remove the least recently used content until we're in budget.
+
+        Other workers may be evicting at the same time, so files can
+        vanish under us; that's fine.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.tmp-'):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class ArrayCache(DiskCache):
+    """
+    NumPy arrays, memory-mapped read-only on the way out, so all the
+    workers share one copy of each array in the page cache.
+
+    The OS counts references for us: evicting an array just unlinks the
+    file, and any worker still using a view keeps its mapping until it's
+    done with it.
+    """
+    def path(self, digest):
+        return os.path.join(self.directory, digest + '.npy')
+
+    def get(self, key):
+        """
+        The array and its metadata, or (None, None).
+        """
+        meta = self.get_meta(key)
+        if meta is None:
+            return None, None
+        path = self.path(meta['digest'])
+        try:
+            a = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            self.forget(key)
+            return None, None
+        self.touch(path)
+        return a, meta
+
+    def put(self, key, a, meta):
+        """
+        Store an array and its metadata under key.
+        """
+        b = BytesIO()
+        np.save(b, np.ascontiguousarray(a))
+        content = b.getvalue()
+        super(ArrayCache, self).put(key, _key(key), content, meta)
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls with the same key: the first caller does
+    the work and the others wait for its result.
+
+    Threads in one worker wait on an event. Workers wait on a file lock
+    in the shared directory, leaving a note that they're waiting; the
+    lock holder only writes its result out for them if it finds one.
+    Pass share=False for results that aren't worth pickling, and workers
+    that waited run the call themselves, once the holder is done.
+    """
+    def __init__(self, directory, max_age=60):
+        self.directory = directory
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._calls = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def do(self, key, func, share=True):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._do_shared(_key(key), func, share)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+        return call.result
+
+    def _acquire(self, base, share=True):
+        """
+        Open and lock base.lock, leaving a note if we have to wait and
+        want the result. Returns the file and whether we waited.
+        """
+        while True:
+            lock = open(base + '.lock', 'w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                waited = False
+            except BlockingIOError:
+                if share:
+                    atomic_write(base + '.want', b'')
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                waited = True
+
+            # clean() may have unlinked the file we locked; if so, the
+            # next caller will lock a new one, so we must too.
+            try:
+                current = os.stat(base + '.lock').st_ino
+            except OSError:
+                current = None
+            if current == os.fstat(lock.fileno()).st_ino:
+                return lock, waited
+            lock.close()
+
+    def _do_shared(self, name, func, share=True):
+        """
+        Coalesce across workers.
+        """
+        start = time.time()
+        base = os.path.join(self.directory, name)
+        path = base + '.pkl'
+        lock, waited = self._acquire(base, share)
+        with lock:
+            try:
+                if waited and share:
+                    try:
+                        if os.stat(path).st_mtime >= start:
+                            with open(path, 'rb') as f:
+                                return pickle.load(f)
+                    except (OSError, EOFError, pickle.UnpicklingError):
+                        pass
+
+                result = func()
+                if share and self._wanted(base):
+                    try:
+                        atomic_write(path, pickle.dumps(result, protocol=4))
+                    except (OSError, pickle.PicklingError):
+                        pass
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self.clean()
+        return result
+
+    def _wanted(self, base):
+        """
+        Whether another worker is waiting for this result. Takes the note.
+        """
+        try:
+            os.remove(base + '.want')
+            return True
+        except OSError:
+            return False
+
+    def clean(self):
+        """
+        Remove results, notes and locks nobody can be waiting for any
+        more. Locks still held are left alone, however old.
+        """
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                if now - entry.stat().st_mtime <= self.max_age:
+                    continue
+                if not entry.name.endswith('.lock'):
+                    os.remove(entry.path)
+                    continue
+                with open(entry.path, 'a') as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.remove(entry.path)
+            except OSError:
+                pass
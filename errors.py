@@ -11,7 +11,7 @@ class InvalidUsage(Exception):
     status_code = 400
 
     def __init__(self, message, status_code=None, payload=None):
-        Exception.__init__(self)
+        Exception.__init__(self, message)
         self.message = message
         if status_code is not None:
             self.status_code = status_code
@@ -21,3 +21,16 @@ class InvalidUsage(Exception):
         rv = dict(self.payload or ())
         rv['message'] = self.message
         return rv
+
+
+class Overloaded(InvalidUsage):
+    """
+    The server is too busy for this request; try again in retry_after
+    seconds.
+    """
+    status_code = 503
+
+    def __init__(self, message, retry_after=1, status_code=None,
+                 payload=None):
+        InvalidUsage.__init__(self, message, status_code, payload)
+        self.retry_after = retry_after
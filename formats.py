@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Response formats for ageobot.
+
+Results are built as a nested dict that may contain NumPy arrays. JSON
+clients get the arrays as lists, as before; clients that can parse arrays
+can ask for a binary format instead and skip the float-to-text round trip.
+
+Choose the format with the `format` parameter or the Accept header:
+
+    json     application/json (default)
+    npz      application/x-npz, NumPy archive; arrays are stored under
+             dotted names like `result.spectrum` and everything else is
+             in the JSON string `meta`.
+    msgpack  application/x-msgpack, arrays are maps of dtype, shape and
+             raw little-endian bytes. Needs the msgpack package.
+
+Any format is compressed with zstd or gzip if the client accepts it.
+
+Streamed responses, from /freq/stream, are a series of events, either as
+Server-Sent Events (text/event-stream, the default) or as NDJSON
+(application/x-ndjson), one {"event": ..., "data": ...} object a line.
+They aren't compressed, since that would hold events back.
+"""
+from io import BytesIO
+import gzip
+import json
+
+import numpy as np
+from flask import Response, jsonify
+
+from errors import InvalidUsage
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MIMETYPES = {'json': 'application/json',
+             'npz': 'application/x-npz',
+             'msgpack': 'application/x-msgpack',
+             'sse': 'text/event-stream',
+             'ndjson': 'application/x-ndjson',
+             }
+
+# Formats for streamed responses, in order of preference.
+STREAMS = ['sse', 'ndjson']
+
+# Responses smaller than this aren't worth compressing.
+MIN_COMPRESS = 1024
+
+
+def available():
+    """
+    The formats this server can produce, in order of preference.
+    """
+    fmts = ['json', 'npz']
+    if msgpack is not None:
+        fmts.append('msgpack')
+    return fmts
+
+
+def negotiate(req):
+    """
+    Decide on the response format from the request.
+    """
+    fmt = req.values.get('format')
+    if fmt:
+        fmt = fmt.lower()
+        if fmt == 'npy':
+            fmt = 'npz'
+        if fmt not in available():
+            mess = 'format must be one of {}'.format(', '.join(available()))
+            raise InvalidUsage(mess, status_code=410)
+        return fmt
+
+    offered = [MIMETYPES[f] for f in available()]
+    best = req.accept_mimetypes.best_match(offered, default=offered[0])
+    return {v: k for k, v in MIMETYPES.items()}[best]
+
+
+def negotiate_stream(req):
+    """
+    Decide on the format of a streamed response from the request.
+    """
+    fmt = (req.values.get('format') or '').lower()
+    if fmt:
+        if fmt not in STREAMS:
+            mess = 'format must be one of {}'.format(', '.join(STREAMS))
+            raise InvalidUsage(mess, status_code=410)
+        return fmt
+
+    offered = [MIMETYPES[f] for f in STREAMS]
+    best = req.accept_mimetypes.best_match(offered, default=offered[0])
+    return {v: k for k, v in MIMETYPES.items()}[best]
+
+
+def _walk(obj, func, path=()):
+    """
+    Apply func(path, array) to every array in a nested dict, and make
+    NumPy scalars into Python ones.
+    """
+    if isinstance(obj, np.ndarray):
+        return func(path, obj)
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, dict):
+        return {k: _walk(v, func, path + (k,)) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_walk(v, func, path) for v in obj]
+    return obj
+
+
+def _compact(a):
+    """
+    Floats don't need 64 bits to describe a spectrum.
+    """
+    if a.dtype.kind == 'f':
+        return a.astype('<f4')
+    return a.astype(a.dtype.newbyteorder('<'))
+
+
+def _scalar(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('Cannot serialize {}'.format(type(obj)))
+
+
+def _npz(result):
+    arrays = {}
+
+    def pull(path, a):
+        name = '.'.join(path)
+        arrays[name] = _compact(a)
+        return name
+
+    meta = _walk(result, pull)
+    arrays['meta'] = np.array(json.dumps(meta, default=_scalar))
+    b = BytesIO()
+    np.savez(b, **arrays)
+    return b.getvalue()
+
+
+def _msgpack(result):
+    def pack(path, a):
+        a = _compact(a)
+        return {'dtype': a.dtype.str,
+                'shape': list(a.shape),
+                'data': a.tobytes()}
+
+    return msgpack.packb(_walk(result, pack),
+                         use_bin_type=True,
+                         default=_scalar)
+
+
+def _compress(response, req):
+    """
+    Apply Content-Encoding if the client wants it and it's worth it.
+    """
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS:
+        return response
+
+    accept = req.accept_encodings
+    if zstandard is not None and accept['zstd']:
+        data = zstandard.ZstdCompressor().compress(data)
+        encoding = 'zstd'
+    elif accept['gzip']:
+        data = gzip.compress(data, compresslevel=6)
+        encoding = 'gzip'
+    else:
+        return response
+
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def encode_event(event, data, fmt='sse'):
+    """
+    One event of a streamed response, as a Server-Sent Event or a line
+    of NDJSON.
+    """
+    data = json.dumps(_walk(data, lambda path, a: a.tolist()))
+    if fmt == 'ndjson':
+        return '{{"event": "{}", "data": {}}}\n'.format(event, data)
+    return 'event: {}\ndata: {}\n\n'.format(event, data)
+
+
+def make_response(result, fmt, req):
+    """
+    Encode a result dict, possibly holding arrays, as a response.
+    """
+    if fmt == 'npz':
+        response = Response(_npz(result), mimetype=MIMETYPES['npz'])
+    elif fmt == 'msgpack':
+        response = Response(_msgpack(result), mimetype=MIMETYPES['msgpack'])
+    else:
+        response = jsonify(_walk(result, lambda path, a: a.tolist()))
+
+    response.vary.add('Accept')
+    return _compress(response, req)
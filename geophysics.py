@@ -61,6 +61,32 @@ def trim_mean(i, proportion):
     return np.nanmean(a[k:-k])
 
 
+def bootstrap_ci(x, ci=95, nboot=1000, trim=0, seed=0):
+    """
+    Percentile bootstrap confidence interval for the mean, or the trim
+    mean if trim is a proportion, of x. NaNs are ignored.
+
+    All the resamples are drawn as one index matrix and averaged along
+    its rows, so thousands cost about as much as one. Seeded, so the
+    same data give the same interval.
+    """
+    x = np.asarray(x, dtype=float)
+    x = x[~np.isnan(x)]
+    if x.size < 2:
+        return np.nan, np.nan
+
+    rng = np.random.RandomState(seed)
+    samples = x[rng.randint(0, x.size, size=(nboot, x.size))]
+    k = int(np.floor(x.size * trim))
+    if k:
+        samples = np.sort(samples, axis=1)[:, k:-k]
+    means = samples.mean(axis=1)
+
+    tail = (100 - ci) / 2
+    lo, hi = np.percentile(means, [tail, 100 - tail])
+    return lo, hi
+
+
 def parabolic(f, x):
     """
     Interpolation.
@@ -116,6 +142,26 @@ def get_spectrum(signal, fs):
     return f, a, f_min, f_max
 
 
+def wavelet_from_spectrum(amp, n, dt, phase=0, length=0.128):
+    """
+    A wavelet with amplitude spectrum amp, the rfft of n samples at dt,
+    rotated by a constant phase in degrees, the same way hilbert() does.
+    Returns the time axis, centred on zero and length long, and the
+    samples, normalised to a peak of 1.
+    """
+    amp = np.ravel(amp)
+    w = np.fft.irfft(amp * np.exp(1j * np.radians(phase)), n)
+    w = np.fft.fftshift(w)
+    t = (np.arange(n) - n // 2) * dt
+
+    keep = np.abs(t) <= length / 2
+    t, w = t[keep], w[keep]
+    peak = np.amax(np.abs(w))
+    if peak:
+        w = w / peak
+    return t, w
+
+
 def freq_from_fft(signal, fs):
     """
     Dominant frequency from FFT.
@@ -164,17 +210,135 @@ def get_phase(i):
     return np.nanmean(results)
 
 
-def get_trace_indices(y, ntraces, spacing):
+def resample_traces(a, n):
+    """
+    Resample the columns of a to n samples in the frequency domain, by
+    zero-padding or truncating their spectra all at once. Unlike an
+    image filter, this leaves the spectrum below the new Nyquist alone.
+
+    Integer arrays come back as the same type, rounded and clipped;
+    anything else comes back as float.
+    """
+    m = a.shape[0]
+    if n == m:
+        return a
+
+    # The FFT treats a trace as periodic, so its two ends would ring
+    # against each other. Mirrored, the ends meet, and we keep half.
+    X = np.fft.rfft(np.concatenate([a, a[::-1]], axis=0), axis=0)
+    Y = np.zeros((n + 1,) + X.shape[1:], dtype=X.dtype)
+    k = min(m, n)
+    Y[:k + 1] = X[:k + 1]
+
+    # The Nyquist bin of the shorter signal stands for +/- N/2 together.
+    Y[k] *= 2 if n < m else 0.5
+
+    y = np.fft.irfft(Y, 2 * n, axis=0)[:n] * (n / m)
+    if a.dtype.kind in 'iu':
+        info = np.iinfo(a.dtype)
+        return np.clip(np.round(y), info.min, info.max).astype(a.dtype)
+    return y
+
+
+def get_trace_indices(y, ntraces, spacing, seed=None):
+    """
+    Column numbers of ntraces traces across an image y columns wide.
+    Random spacing is repeatable if you give a seed.
+    """
     if spacing == 'random':
-        x = 0.05 + 0.9*np.random.random(ntraces)  # avoids edges
+        rng = np.random.RandomState(seed)
+        x = 0.05 + 0.9*rng.random_sample(ntraces)  # avoids edges
         ti = np.sort(x * y)
     else:
         n = ntraces + 1
-        ti = np.arange(1./n, 1., 1./n) * y
-    return np.round(ti).astype(int)
+        ti = np.arange(1, n) / n * y
+    return np.clip(np.round(ti), 0, y - 1).astype(int)
 
 
-def analyse(i, t_min, t_max, trace_indices, func):
+def trace_quality(traces, lo, hi, min_std=0.01, max_clip=0.3,
+                  max_xing=0.4):
+    """
+    Which columns of an array of traces are worth analysing, all at once.
+
+    A trace is rejected if it's dead (its SD is less than min_std of the
+    range lo to hi), clipped (more than max_clip of its samples are at lo
+    or hi), or if it crosses its mean fewer than twice or on more than
+    max_xing of its samples, which is blank paper or text, not seismic.
+    """
+    a = np.asarray(traces, dtype=np.float32)
+    lo, hi = float(lo), float(hi)  # hi - lo overflows in int8.
+    std = a.std(axis=0)
+    clip = ((a <= lo) | (a >= hi)).mean(axis=0)
+    d = np.signbit(a - a.mean(axis=0))
+    xings = (d[1:] != d[:-1]).sum(axis=0)
+    density = xings / max(a.shape[0] - 1, 1)
+    return ((std >= min_std * (hi - lo)) &
+            (clip <= max_clip) &
+            (xings >= 2) &
+            (density <= max_xing))
+
+
+def screen_traces(i, trace_indices, window=None):
+    """
+    Replace the columns of i that aren't worth analysing with the nearest
+    good ones, up to window columns away; by default half the gap between
+    traces. Returns the new indices and the number rejected.
+
+    If nothing is any good, the indices are returned unchanged.
+    """
+    lo, hi = float(i.min()), float(i.max())
+    ok = trace_quality(i[:, trace_indices], lo, hi)
+    rejected = int((~ok).sum())
+    if not rejected:
+        return trace_indices, 0
+
+    width = i.shape[1]
+    if window is None:
+        window = max(width // (2 * len(trace_indices)), 1)
+
+    chosen = set(trace_indices[ok].tolist())
+    for ti in trace_indices[~ok]:
+        near = np.arange(max(ti - window, 0), min(ti + window + 1, width))
+        near = near[np.argsort(np.abs(near - ti), kind='mergesort')]
+        near = near[[n not in chosen for n in near]]
+        if not near.size:
+            continue
+        good = near[trace_quality(i[:, near], lo, hi)]
+        if good.size:
+            chosen.add(int(good[0]))
+
+    if not chosen:
+        return trace_indices, rejected
+    return np.array(sorted(chosen), dtype=int), rejected
+
+
+def value_counts(i):
+    """
+    How many of each value an int8 image has, from -128 up, or None for
+    any other type. Enough to make its histogram with any bins.
+    """
+    if i.dtype != np.int8:
+        return None
+    return np.bincount(i.ravel().astype(np.int16) + 128, minlength=256)
+
+
+def histogram_from_counts(counts, bins):
+    """
+    The same as np.histogram(i, bins) from value_counts(i).
+    """
+    values = np.arange(-128, 128)
+    seen = np.flatnonzero(counts)
+    vmin, vmax = values[seen[0]], values[seen[-1]]
+    hist, edges = np.histogram(values, bins, range=(vmin, vmax),
+                               weights=counts)
+    return hist.astype(np.int64), edges
+
+
+def iter_analyse(i, t_min, t_max, trace_indices, func, batch=10):
+    """
+    As analyse(), but yield the lists so far after every batch of traces,
+    and once more at the end.
+    """
     fs = i.shape[0] / (t_max - t_min)
 
     spec, freq, phase, snr = [], [], [], []
@@ -183,8 +347,8 @@ def analyse(i, t_min, t_max, trace_indices, func):
     print("****** i has shape", i.shape)
     print("****** traceindices", trace_indices)
 
-    for ti in trace_indices:
-        trace = i[:, ti]
+    for n, ti in enumerate(trace_indices, 1):
+        trace = np.array(i[:, ti])  # i may be a read-only shared view.
         try:
             f = func(trace, fs)
             print("**************** f", f)
@@ -199,7 +363,7 @@ def analyse(i, t_min, t_max, trace_indices, func):
             print("**!! phase ** ", e)
 
         try:
-            snr.append(get_snr(trace))
+            snr.append(get_snr(trace.copy()))  # It shifts in place.
         except Exception as e:
             print("**!! snr ** ", e)
 
@@ -211,4 +375,14 @@ def analyse(i, t_min, t_max, trace_indices, func):
         except Exception as e:
             print("**!! spec ** ", e)
 
-    return spec, freq, phase, snr, mis, mas
+        if not n % batch and n < len(trace_indices):
+            yield spec, freq, phase, snr, mis, mas
+
+    yield spec, freq, phase, snr, mis, mas
+
+
+def analyse(i, t_min, t_max, trace_indices, func):
+    for lists in iter_analyse(i, t_min, t_max, trace_indices, func,
+                              batch=len(trace_indices) or 1):
+        pass
+    return lists
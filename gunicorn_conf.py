@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn settings for ageobot. The Docker image uses this file in place
+of its own, and it takes the same environment variables:
+
+    WEB_CONCURRENCY, WORKERS_PER_CORE, HOST, PORT, BIND, LOG_LEVEL
+
+The app is loaded and warmed up once, before forking, so workers start
+in milliseconds and share the imported modules' memory. Set PRELOAD=false
+to load it in each worker instead, e.g. to pick up code changes on HUP.
+
+Each worker logs how long it took to start and its resident memory, and
+reports them at /status.
+"""
+import multiprocessing
+import os
+import time
+
+_started = time.time()
+
+cores = multiprocessing.cpu_count()
+workers_per_core = float(os.getenv('WORKERS_PER_CORE', '2'))
+if os.getenv('WEB_CONCURRENCY'):
+    workers = int(os.getenv('WEB_CONCURRENCY'))
+else:
+    workers = max(int(workers_per_core * cores), 2)
+
+bind = os.getenv('BIND') or '{}:{}'.format(os.getenv('HOST', '0.0.0.0'),
+                                           os.getenv('PORT', '80'))
+loglevel = os.getenv('LOG_LEVEL', 'info')
+keepalive = 120
+errorlog = '-'
+
+preload_app = os.getenv('PRELOAD', 'true').lower() not in ('false', '0', 'no')
+
+
+def when_ready(server):
+    """
+    In the master, after loading the app and before forking workers.
+    """
+    import utils
+    if preload_app:
+        import app
+        start = time.time()
+        app.warm_up()
+        server.log.info('Warmed up in {:.2f} s'.format(time.time() - start))
+    server.log.info('Ready in {:.2f} s, master RSS {:.0f} MB'.format(
+        time.time() - _started, utils.rss_mb()))
+
+
+def pre_fork(server, worker):
+    worker.forked = time.time()
+
+
+def post_worker_init(worker):
+    """
+    In each worker, once it has the app and is about to serve.
+    """
+    import app
+    import utils
+    seconds = time.time() - worker.forked
+    app.startup['time'] = worker.forked
+    app.startup['seconds'] = round(seconds, 3)
+    worker.log.info('Worker {} started in {:.3f} s, RSS {:.0f} MB'.format(
+        worker.pid, seconds, utils.rss_mb()))
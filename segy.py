@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """
-Son of segypy: A Python module for writing 2D SEG-Y formatted data.
+Son of segypy: A Python module for reading and writing SEG-Y formatted data.
 
 Thomas Mejer Hansen, 2005-2006
 Pete Forman 2006
@@ -8,10 +8,12 @@ Andrew Squelch 2007
 Agile Geoscience 2015 — write segy only
 source: http://segymat.cvs.sourceforge.net/viewvc/segymat/SegyPY/segypy.py
 
-TODO:
-    Extend to 3D.
+3D volumes are written a block of traces at a time with
+write_segy_volume().
 """
+import os
 import struct
+import tempfile
 
 import numpy as np
 
@@ -20,6 +22,38 @@ from utils import SH_def
 from utils import STH_def
 
 
+#  NumPy equivalents of the header types; SEG-Y is always big endian.
+NP_TYPES = {'int32': '>i4', 'uint16': '>u2', 'int16': '>i2'}
+
+#  Traces are written this many bytes at a time.
+CHUNK_BYTES = 4 * 1024**2
+
+#  Sample dtypes by DataSampleFormat. IBM floats are decoded on reading.
+SAMPLE_DTYPES = {1: '>u4', 2: '>i4', 3: '>i2', 5: '>f4', 8: 'i1'}
+
+
+def _header_dtype(defs, start, itemsize):
+    """
+    A structured dtype for a header, from SH_def or STH_def.
+    """
+    names, formats, offsets = [], [], []
+    for key, d in defs.items():
+        fmt = NP_TYPES[d['type']]
+        if 'n' in d:
+            fmt = (fmt, d['n'])
+        names.append(key)
+        formats.append(fmt)
+        offsets.append(d['pos'] - start)
+    return np.dtype({'names': names,
+                     'formats': formats,
+                     'offsets': offsets,
+                     'itemsize': itemsize})
+
+
+BINARY_HEADER = _header_dtype(SH_def, 3200, 400)
+TRACE_HEADER = _header_dtype(STH_def, 0, 240)
+
+
 def _getDefaultSegyHeader(ntraces, ns, dt):
     """
     Set up the default filewide header.
@@ -66,50 +100,35 @@ def _getDefaultSegyTraceHeaders(ntraces, ns, dt, t_min):
     return STH
 
 
-def _writeSegyStructure(fo, data, SH, STH):
+def _writeSegyStructure(fo, data, SH, STH, scale=None):
     """
     internal method
+
+    Writes strictly in order, so fo can be a stream. Returns the scale
+    applied to integer samples.
     """
-    revision = SH["SegyFormatRevisionNumber"]
     dsf = SH["DataSampleFormat"]
-    if revision in [100, 256]:
-        revision = 1
+    if scale is None:
+        scale = default_scale(data, dsf)
 
     # WRITE SEGY HEADER
-    for key in SH_def:
-        pos = SH_def[key]["pos"]
-        fmt = SH_def[key]["type"]
-        value = SH[key]
-
-        _putValue(value, fo, pos, fmt)
-
-    # WRITE SEGY TRACES
-    ctype = SH_def['DataSampleFormat']['datatype'][revision][dsf]
-    bps = SH_def['DataSampleFormat']['bps'][revision][dsf]
-
-    sizeT = 240 + SH['ns']*bps
-
-    for i, tr in enumerate(data):
-
-        index = 3600 + i*sizeT
-
-        # WRITE TRACE HEADER
+    fo.write(bytes(3200))  # Blank textual header.
+    fo.write(_binary_header(SH).tobytes())
+
+    # WRITE SEGY TRACES, a chunk at a time, encoding as we go, so there's
+    # never an encoded copy of all the data in memory.
+    dtype = np.dtype([('header', TRACE_HEADER),
+                      ('data', SAMPLE_DTYPES[dsf], SH['ns'])])
+    step = max(1, CHUNK_BYTES // dtype.itemsize)
+    for start in range(0, len(data), step):
+        chunk = slice(start, start + step)
+        traces = np.zeros(len(data[chunk]), dtype=dtype)
         for key in STH_def:
-            pos = index + STH_def[key]["pos"]
-            fmt = STH_def[key]["type"]
-            value = STH[key][i]
-            _putValue(value, fo, pos, fmt)
-
-        # WRITE DATA
-        cformat = '>' + ctype  # Always big endian.
-        for j, s in enumerate(tr):
-            strVal = struct.pack(cformat, s)
-            fo.seek(index + 240 + j*struct.calcsize(cformat))
-            fo.write(strVal)
+            traces['header'][key] = STH[key][chunk]
+        traces['data'], _ = encode_samples(data[chunk], dsf, scale)
+        fo.write(traces.tobytes())
 
-    fo.seek(0)
-
-    return None
+    return scale
 
 
 def _putValue(value, fo, index, ctype):
@@ -127,26 +146,397 @@ def _putValue(value, fo, index, ctype):
     return None
 
 
-def write_segy(data, fo, dt, t_min, STHin={}, SHin={}):
+def write_segy(data, fo, dt, t_min, STHin={}, SHin={},
+               sample_format=5, scale=None):
     """
     write_segy
 
-    Times in seconds.
+    data is shape (ntraces, ns). Times in seconds.
 
+    sample_format is the SEG-Y DataSampleFormat: 1 (IBM float), 2, 3 or 8
+    (32, 16 or 8 bit integer), or 5 (IEEE float, the default). Integer
+    samples are multiplied by scale, which by default fills the range of
+    the type, unless the data are integers that already fit. Returns the
+    scale used.
     """
     ns = data.shape[1]
     ntraces = data.shape[0]
 
     SH = _getDefaultSegyHeader(ntraces, ns, dt)
+    SH["DataSampleFormat"] = sample_format
     STH = _getDefaultSegyTraceHeaders(ntraces, ns, dt, t_min)
 
     # ADD STHin, if exists...
     for key in STHin:
-        for a in range(ntraces):
-            STH[key] = STHin[key][a]
+        STH[key][:] = STHin[key]
 
     # ADD SHin, if exists...
-        for key in SHin:
-            SH[key] = SHin[key]
+    for key in SHin:
+        SH[key] = SHin[key]
+
+    return _writeSegyStructure(fo, data, SH, STH, scale)
+
+
+def write_segy_volume(blocks, fo, dt, t_min,
+                      first_inline=1, first_xline=1,
+                      x0=0, y0=0, dx=25, dy=25,
+                      SHin={}, sample_format=5, scale=None):
+    """
+    Write a 3D volume from an iterable of 2D blocks of traces, each shape
+    (nxlines, ns) and each one inline, in order. Only one block is in
+    memory at a time, and the output is written strictly in order, so fo
+    can be a stream.
+
+    Inline3D, Crossline3D, cdp, cdpX and cdpY are filled in for every
+    trace, with cdpX = x0 + dx * crossline index and cdpY = y0 + dy *
+    inline index.
+
+    sample_format and scale are as for write_segy(), but a default scale
+    is set from the first block, so later blocks may clip.
+
+    Times in seconds. Returns the number of traces written.
+    """
+    ntraces, most = 0, 0
+    ns = None
+    for n_il, block in enumerate(blocks):
+        block = np.asarray(block)
+        nxl = block.shape[0]
+
+        if ns is None:
+            # We know enough to write the file header now.
+            ns = block.shape[1]
+            SH = _getDefaultSegyHeader(nxl, ns, dt)
+            SH["DataSampleFormat"] = sample_format
+            SH["DataTracePerEnsemble"] = nxl
+            SH.update(SHin)
+            fo.write(bytes(3200))  # Blank textual header.
+            fo.write(_binary_header(SH).tobytes())
+        elif block.shape[1] != ns:
+            raise ValueError('Every block must have {} samples.'.format(ns))
+
+        samples, scale = encode_samples(block, sample_format, scale)
+        xl = np.arange(nxl)
+        traces = np.zeros(nxl, dtype=[('header', TRACE_HEADER),
+                                      ('data', samples.dtype, ns)])
+        h = traces['header']
+        h['TraceSequenceLine'] = xl + 1
+        h['TraceSequenceFile'] = ntraces + xl + 1
+        h['FieldRecord'] = first_inline + n_il
+        h['TraceNumber'] = xl + 1
+        h['cdp'] = ntraces + xl + 1
+        h['ns'] = ns
+        h['dt'] = int(dt * 1000000)  # microseconds
+        h['DelayRecordingTime'] = int(t_min * 1000)  # milliseconds
+        h['Inline3D'] = first_inline + n_il
+        h['Crossline3D'] = first_xline + xl
+        h['cdpX'] = np.round(x0 + dx * xl)
+        h['cdpY'] = np.round(y0 + dy * n_il)
+        traces['data'] = samples
+
+        fo.write(traces.tobytes())
+        ntraces += nxl
+        most = max(most, nxl)
+
+    # Ensembles turned out to be different sizes; record the largest.
+    # Compressed streams may claim to be seekable, but only forwards.
+    if ntraces and (most != SH["DataTracePerEnsemble"]) and fo.seekable():
+        try:
+            end = fo.tell()
+            pos = SH_def["DataTracePerEnsemble"]["pos"]
+            _putValue(most, fo, pos, "int16")
+            fo.seek(end)
+        except (OSError, ValueError):
+            pass
+
+    return ntraces
+
+
+def _binary_header(SH):
+    """
+    The 400-byte file header as a structured array.
+    """
+    rec = np.zeros(1, dtype=BINARY_HEADER)
+    for key in SH_def:
+        rec[key] = SH[key]
+    return rec
+
+
+def encode_samples(data, sample_format, scale=None):
+    """
+    Convert samples to their big-endian form on disk. Returns the array
+    and the scale applied, which is only ever not 1 for integer formats.
+    """
+    data = np.asarray(data)
+    if sample_format not in SAMPLE_DTYPES:
+        raise ValueError('Unsupported sample format {}'.format(sample_format))
+
+    if sample_format == 5:
+        return data.astype('>f4'), 1
+    if sample_format == 1:
+        return ieee2ibm(data).astype('>u4'), 1
+
+    dtype = np.dtype(SAMPLE_DTYPES[sample_format])
+    info = np.iinfo(dtype)
+    if scale is None:
+        scale = default_scale(data, sample_format)
+    scaled = np.clip(np.round(np.nan_to_num(data * scale)), info.min, info.max)
+    return scaled.astype(dtype), scale
+
+
+def default_scale(data, sample_format):
+    """
+    The scale that fills the range of an integer format, or 1 if the
+    data are integers that already fit, or for float formats. Doesn't
+    copy the data, so it's cheap to find before encoding in pieces.
+    """
+    data = np.asarray(data)
+    if sample_format not in SAMPLE_DTYPES:
+        raise ValueError('Unsupported sample format {}'.format(sample_format))
+    if sample_format in (1, 5) or not data.size:
+        return 1
+
+    info = np.iinfo(np.dtype(SAMPLE_DTYPES[sample_format]))
+    lo, hi = np.nanmin(data), np.nanmax(data)
+    if (data.dtype.kind in 'iu') and (lo >= info.min) and (hi <= info.max):
+        return 1
+    biggest = max(abs(float(lo)), abs(float(hi)))
+    if not biggest or np.isnan(biggest):
+        return 1
+    return info.max / biggest
+
+
+def ieee2ibm(a):
+    """
+    Encode floats as IBM System/360 floats, returned as uint32.
+    Vectorized, and the inverse of ibm2ieee().
+    """
+    a = np.nan_to_num(np.asarray(a, dtype=np.float64))
+    sign = (a < 0).astype(np.uint32) << 31
+
+    # x = f * 2**p with 0.5 <= f < 1, then rewrite as m * 16**e.
+    f, p = np.frexp(np.abs(a))
+    e = -(-p // 4)  # ceil(p / 4)
+    m = np.ldexp(f, p - 4 * e)  # 1/16 <= m < 1
+    mantissa = np.round(np.ldexp(m, 24)).astype(np.int64)
 
-    _writeSegyStructure(fo, data, SH, STH)
+    # Rounding can carry into the next hex digit.
+    carry = mantissa >= 2**24
+    mantissa = np.where(carry, mantissa >> 4, mantissa)
+    e = e + carry
+
+    exponent = e + 64
+    zero = (f == 0) | (exponent < 0)
+    big = exponent > 127
+    mantissa = np.where(big, 0xffffff, np.where(zero, 0, mantissa))
+    exponent = np.clip(exponent, 0, 127)
+    exponent = np.where(zero, 0, exponent)
+
+    return sign | (exponent.astype(np.uint32) << 24) | \
+        mantissa.astype(np.uint32)
+
+
+def ibm2ieee(a):
+    """
+    Decode IBM System/360 floats, given as uint32, to float32.
+    Vectorized: no Python loop over samples.
+    """
+    a = np.asarray(a, dtype=np.uint32)
+    sign = np.where(a >> 31, -1.0, 1.0)
+    exponent = ((a >> 24) & 0x7f).astype(np.int32) - 64
+    mantissa = (a & 0x00ffffff) / float(0x01000000)
+    return (sign * mantissa * np.power(16.0, exponent)).astype(np.float32)
+
+
+class SegyReader(object):
+    """
+    Read a SEG-Y file without loading it.
+
+    The file is memory-mapped, and the traces are a structured array over
+    the mapping, so `data` is a zero-copy big-endian view and nothing is
+    read from disk until it's touched. Assumes fixed-length traces.
+
+    Args:
+        source: A filename, an open file, or bytes.
+    """
+    def __init__(self, source):
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            buf = np.frombuffer(source, dtype=np.uint8)
+        else:
+            buf = np.memmap(source, dtype=np.uint8, mode='r')
+        self._buf = buf
+
+        if buf.size < 3600:
+            raise ValueError('File is too small to be SEG-Y.')
+
+        self.text = bytes(buf[:3200])
+        record = buf[3200:3600].view(BINARY_HEADER)[0]
+        self.header = {k: record[k] for k in BINARY_HEADER.names
+                       if not k.startswith('Unassigned')}
+
+        self.format = int(self.header['DataSampleFormat'])
+        if self.format not in SAMPLE_DTYPES:
+            raise ValueError('Unsupported sample format {}'.format(self.format))
+
+        start = 3600 + 3200 * int(self.header['NumberOfExtTextualHeaders'])
+        first = buf[start:start+240].view(TRACE_HEADER)[0]
+        self.ns = int(self.header['ns'] or first['ns'])
+        dt = int(self.header['dt'] or first['dt'])
+        self.dt = dt / 1000000  # seconds
+        self.t_min = int(first['DelayRecordingTime']) / 1000  # seconds
+
+        self.dtype = np.dtype([('header', TRACE_HEADER),
+                               ('data', SAMPLE_DTYPES[self.format], self.ns)])
+        self.ntraces = (buf.size - start) // self.dtype.itemsize
+        end = start + self.ntraces * self.dtype.itemsize
+        self.offset = start
+        self.traces = buf[start:end].view(self.dtype)
+        self.path = source if isinstance(source, str) else None
+
+    @property
+    def t_max(self):
+        return self.t_min + self.ns * self.dt
+
+    @property
+    def data(self):
+        """
+        All the samples, shape (ntraces, ns), as stored on disk.
+        """
+        return self.traces['data']
+
+    def trace_headers(self, field):
+        """
+        One trace header field for every trace. Only the header bytes
+        are read.
+        """
+        return self.traces['header'][field]
+
+    def index(self):
+        """
+        The trace header index for this file, loaded from beside the file
+        if it's there and for a file of this size, otherwise built (and
+        saved, if we can). See TraceIndex.
+        """
+        if self.path is None:
+            return TraceIndex.build(self)
+
+        path = self.path + '.idx.npz'
+        try:
+            index = TraceIndex.load(path)
+            if index.size == self._buf.size:
+                return index
+        except (OSError, ValueError, KeyError):
+            pass
+
+        index = TraceIndex.build(self)
+        try:
+            index.save(path)
+        except OSError:
+            pass
+        return index
+
+    def byte_offsets(self, indices):
+        """
+        Where some traces start in the file, headers included.
+        """
+        return self.offset + np.asarray(indices) * self.dtype.itemsize
+
+    def read_traces(self, indices):
+        """
+        Samples from some traces, as native float32, shape (n, ns).
+        Only those traces are read.
+        """
+        a = self.data[np.asarray(indices)]
+        if self.format == 1:
+            return ibm2ieee(a)
+        return a.astype(np.float32)
+
+
+class TraceIndex(object):
+    """
+    Sorted inline/crossline and CDP numbers of every trace in a file, so
+    we can find traces by number without scanning the file.
+
+    Keys are sorted, so lookups are binary searches, and the result is
+    trace numbers, which are fixed strides into the file.
+    """
+    def __init__(self, keys, traces, cdps, cdp_traces, size):
+        self.size = size  # Of the file, to tell if it's changed.
+        self.keys = keys
+        self.traces = traces
+        self.cdps = cdps
+        self.cdp_traces = cdp_traces
+
+    @staticmethod
+    def _key(inline, xline):
+        """
+        One sortable int64 from an inline and a crossline.
+        """
+        inline = np.asarray(inline, dtype=np.int64)
+        xline = np.asarray(xline, dtype=np.int64) + 2**31
+        return (inline << 32) | xline
+
+    @classmethod
+    def build(cls, reader):
+        """
+        Read the trace headers of a SegyReader. Only the header fields
+        are touched, at a stride of one trace.
+        """
+        h = reader.traces['header']
+        inline = np.array(h['Inline3D'])
+        xline = np.array(h['Crossline3D'])
+        cdp = np.array(h['cdp'])
+
+        keys = cls._key(inline, xline)
+        order = np.argsort(keys, kind='mergesort')
+        cdp_order = np.argsort(cdp, kind='mergesort')
+        return cls(keys[order], order, cdp[cdp_order], cdp_order,
+                   reader._buf.size)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['keys'], f['traces'], f['cdps'], f['cdp_traces'],
+                       int(f['size']))
+
+    def save(self, path):
+        """
+        Save as a compressed .npz, atomically.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.npz')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f,
+                                    keys=self.keys,
+                                    traces=self.traces,
+                                    cdps=self.cdps,
+                                    cdp_traces=self.cdp_traces,
+                                    size=self.size)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def lookup(self, inline=None, xlines=None, cdps=None):
+        """
+        Trace numbers, in file order, for an inline and optional range
+        of crosslines, or for a range of CDPs. Ranges are (first, last),
+        inclusive.
+
+        Example:
+            >>> index.lookup(inline=1200, xlines=(300, 800))
+        """
+        if cdps is not None:
+            lo = np.searchsorted(self.cdps, cdps[0], side='left')
+            hi = np.searchsorted(self.cdps, cdps[1], side='right')
+            return np.sort(self.cdp_traces[lo:hi])
+
+        if inline is None:
+            raise ValueError('Need an inline or a range of CDPs.')
+        if xlines is None:
+            xlines = (-2**31, 2**31 - 1)
+        lo = np.searchsorted(self.keys, self._key(inline, xlines[0]),
+                             side='left')
+        hi = np.searchsorted(self.keys, self._key(inline, xlines[1]),
+                             side='right')
+        return np.sort(self.traces[lo:hi])
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for geophysics: resampling and histograms.
+"""
+import numpy as np
+import pytest
+
+from geophysics import resample_traces
+from geophysics import value_counts, histogram_from_counts
+
+
+def grid(n, m):
+    """
+    Where n samples resampled from m fall, in units of the m samples.
+    """
+    return np.arange(n) * m / n
+
+
+def cosines(t, m, qs):
+    """
+    Cosines with q half cycles over m samples, symmetric about the
+    ends, one per column. Mirrored, they're exactly band-limited.
+    """
+    q = np.asarray(qs)[None, :]
+    return np.cos(np.pi * q * (t[:, None] + 0.5) / m)
+
+
+def ricker_train(t, m, f=0.04):
+    """
+    Ricker wavelets on a trend, so the ends don't match, like a real
+    trace. f is in cycles per sample of the m.
+    """
+    s = 0.5 * t / m - 0.2
+    for centre in (0.1, 0.35, 0.6, 0.9):
+        a = (np.pi * f * (t - centre * m))**2
+        s = s + (1 - 2 * a) * np.exp(-a)
+    return s
+
+
+@pytest.mark.parametrize('m, n', [(64, 128), (64, 100), (63, 128),
+                                  (63, 101), (15, 40), (16, 17)])
+def test_upsample(m, n):
+    qs = [1, 4, 9]
+    y = resample_traces(cosines(np.arange(m), m, qs), n)
+    assert y.shape == (n, 3)
+    assert np.allclose(y, cosines(grid(n, m), m, qs), atol=1e-10)
+
+
+@pytest.mark.parametrize('m, n', [(128, 64), (100, 64), (128, 63),
+                                  (101, 63), (40, 15), (17, 16)])
+def test_downsample(m, n):
+    qs = [1, 4, 9]
+    y = resample_traces(cosines(np.arange(m), m, qs), n)
+    assert y.shape == (n, 3)
+    assert np.allclose(y, cosines(grid(n, m), m, qs), atol=1e-10)
+
+
+def test_downsample_removes_high_frequencies():
+    t = np.arange(128)
+    x = cosines(t, 128, [5]) + cosines(t, 128, [100])
+    y = resample_traces(x, 64)
+    assert np.allclose(y, cosines(grid(64, 128), 128, [5]), atol=1e-10)
+
+
+@pytest.mark.parametrize('m, n', [(64, 32), (63, 31), (101, 40)])
+def test_nyquist_downsample(m, n):
+    # A cosine at the new Nyquist survives with its full amplitude.
+    y = resample_traces(cosines(np.arange(m), m, [n]), n)
+    assert np.allclose(y, cosines(grid(n, m), m, [n]), atol=1e-10)
+
+
+@pytest.mark.parametrize('m, n', [(8, 16), (9, 20)])
+def test_nyquist_upsample(m, n):
+    # The highest frequency the mirrored trace can hold.
+    y = resample_traces(cosines(np.arange(m), m, [m - 1]), n)
+    assert np.allclose(y, cosines(grid(n, m), m, [m - 1]), atol=1e-10)
+
+
+@pytest.mark.parametrize('m, n, tol', [(300, 1001, 1e-3), (301, 1000, 1e-3),
+                                       (256, 512, 1e-3), (200, 90, 5e-3),
+                                       (201, 100, 5e-3)])
+def test_not_periodic(m, n, tol):
+    # No ringing where the ends of the trace would wrap around. Beyond
+    # the last input sample we can only guess, so don't look there.
+    t = grid(n, m)
+    inside = t <= m - 1
+    y = resample_traces(ricker_train(np.arange(m), m)[:, None], n)[:, 0]
+    error = np.abs(y - ricker_train(t, m))[inside]
+    assert error.max() < tol
+
+
+def test_not_periodic_int8():
+    # 30 Hz at 2 ms on a trend, as an image column.
+    def trace(t):
+        t = 0.002 * t
+        return 80 * np.sin(2 * np.pi * 30 * t) + 100 * t - 30
+
+    x = np.round(trace(np.arange(300))).astype(np.int8)
+    y = resample_traces(x[:, None], 1001)[:, 0]
+    t = grid(1001, 300)
+    error = np.abs(y - trace(t))[t <= 299]
+    assert error[-30:].max() < 2
+    assert error.max() < 2
+
+
+def test_same_length_is_unchanged():
+    x = cosines(np.arange(50), 50, [2])
+    assert resample_traces(x, 50) is x
+
+
+def test_integer_types_are_kept():
+    x = np.round(100 * cosines(np.arange(60), 60, [2, 3])).astype(np.int8)
+    y = resample_traces(x, 90)
+    assert y.dtype == np.int8
+    expected = 100 * cosines(grid(90, 60), 60, [2, 3])
+    assert np.abs(y - expected).max() <= 2
+
+
+@pytest.mark.parametrize('bins', [1, 2, 11, 64, 300])
+def test_histogram_from_counts(bins):
+    rng = np.random.RandomState(3)
+    i = rng.randint(-90, 70, (120, 80)).astype(np.int8)
+    counts, edges = histogram_from_counts(value_counts(i), bins)
+    expected = np.histogram(i, bins=bins)
+    assert np.array_equal(counts, expected[0])
+    assert counts.dtype == expected[0].dtype
+    assert np.array_equal(edges, expected[1])
+
+
+def test_histogram_from_counts_of_one_value():
+    i = np.full((10, 10), -5, dtype=np.int8)
+    counts, edges = histogram_from_counts(value_counts(i), 11)
+    expected = np.histogram(i, bins=11)
+    assert np.array_equal(counts, expected[0])
+    assert np.array_equal(edges, expected[1])
+
+
+def test_value_counts_only_for_int8():
+    assert value_counts(np.zeros((3, 3))) is None
+    counts = value_counts(np.array([[-128, 127], [0, 0]], dtype=np.int8))
+    assert counts.size == 256
+    assert (counts[0], counts[128], counts[255]) == (1, 2, 1)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for writing and reading SEG-Y.
+"""
+from io import BytesIO
+import gzip
+import math
+
+import numpy as np
+import pytest
+
+from segy import write_segy, write_segy_volume, SegyReader, TraceIndex
+from segy import ieee2ibm, ibm2ieee
+
+
+def synthetic(ntraces=7, ns=251, dt=0.004):
+    t = np.arange(ns) * dt
+    f = np.linspace(10, 40, ntraces)[:, None]
+    data = np.sin(2 * np.pi * f * t) * np.exp(-t)
+    return (1000 * data).astype(np.float32)
+
+
+def round_trip(data, sample_format, dt=0.004, t_min=0.1):
+    fo = BytesIO()
+    scale = write_segy(data, fo, dt, t_min, sample_format=sample_format)
+    reader = SegyReader(fo.getvalue())
+    return reader, scale
+
+
+def ibm_reference(x):
+    """
+    One float as IBM single precision, a digit at a time.
+    """
+    if x == 0:
+        return 0
+    sign = 0x80000000 if x < 0 else 0
+    x, exponent = abs(x), 64
+    while x >= 1:
+        x /= 16
+        exponent += 1
+    while x < 1 / 16:
+        x *= 16
+        exponent -= 1
+    mantissa = int(round(x * 2**24))
+    if mantissa == 2**24:
+        mantissa >>= 4
+        exponent += 1
+    return sign | (exponent << 24) | mantissa
+
+
+@pytest.mark.parametrize('sample_format', [1, 3, 5, 8])
+def test_headers(sample_format):
+    data = synthetic()
+    reader, _ = round_trip(data, sample_format)
+    assert reader.format == sample_format
+    assert reader.ntraces == 7
+    assert reader.ns == 251
+    assert reader.dt == pytest.approx(0.004)
+    assert reader.t_min == pytest.approx(0.1)
+
+
+def test_ieee_round_trip():
+    data = synthetic()
+    reader, scale = round_trip(data, 5)
+    assert scale == 1
+    assert np.array_equal(reader.read_traces(np.arange(7)), data)
+
+
+def test_ibm_round_trip():
+    data = synthetic()
+    reader, scale = round_trip(data, 1)
+    assert scale == 1
+    out = reader.read_traces(np.arange(7))
+    assert np.allclose(out, data, rtol=2**-20, atol=0)
+
+
+@pytest.mark.parametrize('sample_format, dtype', [(3, np.int16),
+                                                  (8, np.int8)])
+def test_integer_round_trip(sample_format, dtype):
+    data = synthetic()
+    reader, scale = round_trip(data, sample_format)
+    assert reader.data.dtype.itemsize == np.dtype(dtype).itemsize
+    out = reader.read_traces(np.arange(7))
+    assert np.abs(out).max() == np.iinfo(dtype).max
+    assert np.abs(out / scale - data).max() <= 0.5 / scale + 1e-6
+
+
+def test_integers_that_fit_are_not_scaled():
+    data = np.arange(-100, 100, dtype=np.int16).reshape(4, 50)
+    reader, scale = round_trip(data, 3)
+    assert scale == 1
+    assert np.array_equal(reader.read_traces(np.arange(4)), data)
+
+
+def test_read_some_traces():
+    data = synthetic()
+    reader, _ = round_trip(data, 5)
+    assert np.array_equal(reader.read_traces([5, 2]), data[[5, 2]])
+
+
+def test_ibm_known_value():
+    # The example in the IBM hexadecimal floating point literature.
+    assert ieee2ibm(np.array([-118.625]))[0] == 0xC276A000
+    assert ibm2ieee(np.array([0xC276A000], dtype='>u4'))[0] == -118.625
+
+
+def test_ibm_matches_reference():
+    rng = np.random.RandomState(42)
+    x = rng.standard_normal(2000) * 10.0**rng.randint(-30, 30, 2000)
+    x = np.concatenate([x.astype(np.float32), [0, 1, -1, 1/16, 15.999999]])
+    expected = [ibm_reference(float(v)) for v in x]
+    assert ieee2ibm(x).tolist() == expected
+
+
+def test_ibm_decode_is_inverse():
+    rng = np.random.RandomState(0)
+    x = (rng.standard_normal(1000) * 1e3).astype(np.float32)
+    y = ibm2ieee(ieee2ibm(x).astype('>u4'))
+    assert np.allclose(y, x, rtol=2**-20, atol=0)
+    assert math.copysign(1, y[np.argmin(x)]) == -1
+
+
+def volume(ninlines=3, nxlines=4, ns=50):
+    """
+    Blocks of a small 3D volume, one inline each, with every sample
+    telling you its inline and crossline.
+    """
+    for il in range(ninlines):
+        yield (100 * il + np.arange(nxlines))[:, None] * np.ones(ns)
+
+
+def test_volume_headers():
+    fo = BytesIO()
+    n = write_segy_volume(volume(), fo, 0.004, 0, first_inline=10,
+                          first_xline=200, x0=1000, y0=5000, dx=12.5,
+                          dy=25)
+    assert n == 12
+    reader = SegyReader(fo.getvalue())
+    assert reader.ntraces == 12
+    assert reader.header['DataTracePerEnsemble'] == 4
+
+    inline = reader.trace_headers('Inline3D')
+    xline = reader.trace_headers('Crossline3D')
+    assert inline.tolist() == [10] * 4 + [11] * 4 + [12] * 4
+    assert xline.tolist() == [200, 201, 202, 203] * 3
+    assert reader.trace_headers('cdpX').tolist() == \
+        [1000, 1012, 1025, 1038] * 3
+    assert reader.trace_headers('cdpY').tolist() == \
+        [5000] * 4 + [5025] * 4 + [5050] * 4
+    assert reader.trace_headers('cdp').tolist() == list(range(1, 13))
+
+    data = reader.read_traces(np.arange(12))
+    expected = (100 * (inline - 10) + (xline - 200))[:, None]
+    assert np.array_equal(data, expected * np.ones((1, 50)))
+
+
+def ragged():
+    yield np.ones((3, 20))
+    yield np.ones((5, 20))
+    yield np.ones((2, 20))
+
+
+def test_volume_ensemble_size_is_patched():
+    fo = BytesIO()
+    assert write_segy_volume(ragged(), fo, 0.004, 0) == 10
+    reader = SegyReader(fo.getvalue())
+    assert reader.header['DataTracePerEnsemble'] == 5
+    assert reader.ntraces == 10
+    assert reader.trace_headers('Inline3D').tolist() == \
+        [1] * 3 + [2] * 5 + [3] * 2
+
+
+def test_volume_to_gzip_stream():
+    # Can't seek back in a compressed stream, so the first block's size
+    # stays in the header, and the data are intact.
+    fo = BytesIO()
+    with gzip.GzipFile(fileobj=fo, mode='wb') as gz:
+        assert write_segy_volume(ragged(), gz, 0.004, 0) == 10
+    reader = SegyReader(gzip.decompress(fo.getvalue()))
+    assert reader.header['DataTracePerEnsemble'] == 3
+    assert reader.ntraces == 10
+    assert np.array_equal(reader.read_traces(np.arange(10)),
+                          np.ones((10, 20)))
+
+
+def index_for(blocks, **kwargs):
+    fo = BytesIO()
+    write_segy_volume(blocks, fo, 0.004, 0, **kwargs)
+    reader = SegyReader(fo.getvalue())
+    return reader, TraceIndex.build(reader)
+
+
+def test_index_lookup_inline():
+    reader, index = index_for(volume(4, 6), first_inline=-2,
+                              first_xline=-3)
+    # Inlines -2 to 1, crosslines -3 to 2; six traces per inline.
+    assert index.lookup(inline=-1).tolist() == list(range(6, 12))
+    assert index.lookup(inline=-2, xlines=(-3, -2)).tolist() == [0, 1]
+    assert index.lookup(inline=0, xlines=(-1, 1)).tolist() == [14, 15, 16]
+    assert index.lookup(inline=1, xlines=(2, 9)).tolist() == [23]
+    assert index.lookup(inline=5).size == 0
+    assert index.lookup(inline=0, xlines=(3, 9)).size == 0
+
+
+def test_index_lookup_cdps():
+    reader, index = index_for(volume(3, 4))
+    assert index.lookup(cdps=(3, 6)).tolist() == [2, 3, 4, 5]
+    assert index.lookup(cdps=(12, 99)).tolist() == [11]
+    assert index.lookup(cdps=(50, 60)).size == 0
+    with pytest.raises(ValueError):
+        index.lookup()
+
+
+def test_index_save_and_load(tmp_path):
+    blocks = list(volume(3, 4))
+    path = str(tmp_path / 'v.sgy')
+    with open(path, 'wb') as f:
+        write_segy_volume(blocks, f, 0.004, 0, first_inline=7)
+
+    reader = SegyReader(path)
+    index = reader.index()
+    assert (tmp_path / 'v.sgy.idx.npz').exists()
+    loaded = TraceIndex.load(path + '.idx.npz')
+    assert loaded.size == index.size == reader._buf.size
+    assert loaded.lookup(inline=8).tolist() == [4, 5, 6, 7]
+    assert loaded.lookup(cdps=(1, 2)).tolist() == [0, 1]
+
+    # A file of another size doesn't use the old index.
+    with open(path, 'wb') as f:
+        write_segy_volume(blocks[:2], f, 0.004, 0, first_inline=20)
+    reader = SegyReader(path)
+    assert reader.index().lookup(inline=20).tolist() == [0, 1, 2, 3]
+    assert TraceIndex.load(path + '.idx.npz').size == reader._buf.size
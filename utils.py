@@ -3,20 +3,59 @@
 Utils for ageobot.
 
 """
+import contextlib
 import datetime
+import gzip
+import hashlib
+import json
+import os
+import re
 import struct
+import tempfile
 
-import boto3
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
+import cache
 
-def get_url(databytes, uuid1):
 
+# Images we've fetched, with their validators, by URL.
+_remote = cache.DiskCache(os.path.join(cache.CACHE_DIR, 'remote'),
+                          cache.CACHE_MB * 1024**2)
+
+
+def compressed_writer(fo, encoding=None):
+    """
+    A file-like object that compresses into fo as it's written to. Use it
+    as a context manager; fo stays open. encoding is None, 'gzip' or
+    'zstd'.
+    """
+    if not encoding:
+        return contextlib.nullcontext(fo)
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=fo, mode='wb', mtime=0)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor().stream_writer(fo, closefd=False)
+    raise ValueError('Unsupported compression {}'.format(encoding))
+
+
+def get_url(databytes, uuid1, encoding=None):
+    """
+    Upload a SEG-Y file to S3 and return a link to it.
+
+    gzip files are stored with Content-Encoding, so clients that can
+    decompress get plain SEG-Y. zstd files, which most clients can't
+    decompress on the fly, get a .zst suffix instead.
+    """
     file_link = ''
     now = datetime.datetime.now()
     expires = now + datetime.timedelta(minutes=240)
     success = False
 
     try:
+        import boto3  # Slow to import, and most requests don't need it.
         session = boto3.session.Session(region_name='us-east-1')
         client = session.client('s3')
         key = uuid1 + '.segy'
@@ -28,6 +67,12 @@ def get_url(databytes, uuid1):
                   'Key': key,
                   'ACL': acl,
                   }
+        if encoding == 'gzip':
+            params['ContentEncoding'] = 'gzip'
+        elif encoding == 'zstd':
+            key += '.zst'
+            params['Key'] = key
+            params['ContentType'] = 'application/zstd'
         r = client.put_object(**params)
         success = r['ResponseMetadata']['HTTPStatusCode'] == 200
     except:
@@ -53,6 +98,142 @@ def get_url(databytes, uuid1):
     return file_link
 
 
+def hash_bytes(content):
+    """
+    Hash of some image bytes, for keys and ETags.
+    """
+    return hashlib.sha256(content).hexdigest()
+
+
+def validators(url):
+    """
+    What we stored when we last fetched a URL, or None, and the headers
+    to revalidate it with.
+    """
+    meta = _remote.get_meta(url)
+    if meta and not os.path.exists(_remote.path(meta['digest'])):
+        _remote.forget(url)  # Its content has been evicted.
+        meta = None
+    headers = {}
+    if meta:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    return meta, headers
+
+
+def cached_content(digest):
+    """
+    Content from the cache, or None if it has been evicted.
+    """
+    return _remote.read(digest)
+
+
+def remember(url, content, headers):
+    """
+    Put fetched content in the cache with the response's validators.
+    Returns the content's digest.
+    """
+    digest = hash_bytes(content)
+    try:
+        _remote.put(url, digest, content,
+                    {'url': url,
+                     'etag': headers.get('ETag'),
+                     'last_modified': headers.get('Last-Modified'),
+                     })
+    except OSError:
+        print('Caching image failed')
+    return digest
+
+
+def fetch_url(url):
+    """
+    Fetch an image from a URL and return (content, digest).
+
+    Images are kept in the on-disk cache shared by the workers. If we
+    have fetched this URL before, we revalidate it with the remote
+    server's own validators, and an unchanged image comes off disk.
+    """
+    import requests
+
+    meta, headers = validators(url)
+    r = requests.get(url, headers=headers)
+    if headers and r.status_code == 304:
+        content = cached_content(meta['digest'])
+        if content is not None:
+            return content, meta['digest']
+        r = requests.get(url)  # Evicted since we looked.
+    r.raise_for_status()
+
+    return r.content, remember(url, r.content, r.headers)
+
+
+def fetch_file(url):
+    """
+    As fetch_url(), for big files: the download is streamed into the
+    cache, not held in memory. Returns (digest, f), with f the cached
+    file, open for reading, so it's there even if it's evicted.
+    """
+    import requests
+
+    meta, headers = validators(url)
+    r = requests.get(url, headers=headers, stream=True)
+    if headers and r.status_code == 304:
+        r.close()
+        try:
+            f = open(_remote.path(meta['digest']), 'rb')
+        except OSError:
+            r = requests.get(url, stream=True)  # Evicted since we looked.
+        else:
+            _remote.touch(f.name)
+            return meta['digest'], f
+
+    with r:
+        r.raise_for_status()
+        h = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=_remote.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in r.iter_content(1024 * 1024):
+                    h.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    digest = h.hexdigest()
+    f = _remote.put_file(url, digest, tmp,
+                         {'url': url,
+                          'etag': r.headers.get('ETag'),
+                          'last_modified': r.headers.get('Last-Modified'),
+                          })
+    return digest, f
+
+
+def cached_path(digest):
+    """
+    The file holding fetched content in the cache, or None if it has
+    already been evicted.
+    """
+    path = _remote.path(digest)
+    if os.path.exists(path):
+        return path
+    return None
+
+
+def make_etag(digest, params, **kwargs):
+    """
+    Key for an analysis: the image hash plus everything that changes
+    the result. /freq sends it as a weak ETag, since responses for the
+    same analysis differ in bytes; it also keys caches and coalescing.
+    """
+    key = {'image': digest, 'params': params}
+    key.update(kwargs)
+    s = json.dumps(key, sort_keys=True, default=str)
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()[:32]
+
+
 def build_params(method, avg,
                  t_min, t_max, dt_param,
                  region, tr_sp,
@@ -75,6 +256,36 @@ def build_params(method, avg,
     return params
 
 
+def parse_range(s):
+    """
+    Parse a number like '1200' or a range like '300-800' into a tuple
+    (first, last). Returns None for an empty string.
+    """
+    if not s:
+        return None
+    m = re.match(r'^\s*(-?\d+)\s*(?:-\s*(-?\d+))?\s*$', s)
+    if m is None:
+        raise ValueError('Not a number or range: {}'.format(s))
+    first = int(m.group(1))
+    last = int(m.group(2)) if m.group(2) is not None else first
+    return first, last
+
+
+def rss_mb():
+    """
+    Resident memory of this process, in MB.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    import resource  # Peak, not current, but better than nothing.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
 def set_type(ctype):
     l_long = struct.calcsize('l')
     l_ulong = struct.calcsize('L')
@@ -106,7 +317,9 @@ def set_type(ctype):
         size = l_float
         ctype = 'f'
     elif (ctype == 'ibm'):
+        # Packed as the raw bits, see segy.ieee2ibm().
         size = l_float
+        ctype = 'L'
     else:
         size = None
         ctype = None
@@ -153,13 +366,13 @@ SH_def["DataSampleFormat"]["datatype"] = {0: {
     1: 'ibm',
     2: 'l',
     3: 'h',
-    8: 'B'}}
+    8: 'b'}}
 SH_def["DataSampleFormat"]["datatype"][1] = {
     1: 'ibm',
     2: 'l',
     3: 'h',
     5: 'f',
-    8: 'B'}
+    8: 'b'}
 
 SH_def["EnsembleFold"] = {"pos": 3226, "type": "int16", "def": 1}
 SH_def["TraceSorting"] = {"pos": 3228, "type": "int16", "def": 4}
@@ -271,7 +484,7 @@ STH_def["MuteTimeStart"] = {"pos": 110, "type": "int16"}  #'int16');  %110
 STH_def["MuteTimeEND"] = {"pos": 112, "type": "int16"}  #'int16');  %112
 STH_def["ns"] = {"pos": 114, "type": "uint16"}  #'uint16');  %114
 STH_def["dt"] = {"pos": 116, "type": "uint16"}  #'uint16');  %116
-STH_def["GainType"] = {"pos": 119, "type": "int16"}  #'int16');  %118
+STH_def["GainType"] = {"pos": 118, "type": "int16"}  #'int16');  %118
 STH_def["GainType"]["descr"] = {0: {
     1: "Fixes",
     2: "Binary",
@@ -345,7 +558,7 @@ STH_def["cdpX"] = {"pos":180,"type": "int32"}  #'int32');  %180
 STH_def["cdpY"] = {"pos":184,"type": "int32"}  #'int32');  %184
 STH_def["Inline3D"] = {"pos":188,"type": "int32"}  #'int32');  %188
 STH_def["Crossline3D"] = {"pos":192,"type": "int32"}  #'int32');  %192
-STH_def["ShotPoint"] = {"pos":192,"type": "int32"}  #'int32');  %196
+STH_def["ShotPoint"] = {"pos":196,"type": "int32"}  #'int32');  %196
 STH_def["ShotPointScalar"] = {"pos":200,"type": "int16"}  #'int16');  %200
 STH_def["TraceValueMeasurementUnit"] = {"pos":202,"type": "int16"}  #'int16');  %202
 STH_def["TraceValueMeasurementUnit"]["descr"]  =  {1: {